@@ -6,12 +6,10 @@ from ROOT import TFile, TCanvas, gROOT, THStack
 
 def study_smearing():
     # Import data and MC files:
-    f_data = TFile.Open("../trees_5gev_e/data_nn50.root", 'read')
+    # Data is selected once with the loosest NN cut: signals_selection.py <file> 0.1 --keep-nn
+    # Other NN cuts are applied here with nn_output branch
+    f_data = TFile.Open("../trees_5gev_e/data_nn10.root", 'read')
     t_data = f_data.data
-    t_data.AddFriend("data10=data", "../trees_5gev_e/data_nn10.root")
-    t_data.AddFriend("data20=data", "../trees_5gev_e/data_nn20.root")
-    t_data.AddFriend("data90=data", "../trees_5gev_e/data_nn90.root")
-    t_data.AddFriend("data99=data", "../trees_5gev_e/data_nn99.root")
 
     f_mc = TFile.Open("../trees_5gev_e/lucas.root", 'read')
     t_mc = f_mc.lumical
@@ -20,40 +18,16 @@ def study_smearing():
     c = TCanvas()
     hs = THStack("hs", "title")
 
-    t_data.Draw("Sum$(data10.energy*(data10.layer == 0))>>h_data10(200, 0, 3)", "Sum$(data10.energy*(data10.layer == 0)) > 0")
-    h_data10 = gROOT.FindObject("h_data10")
-    h_data10.SetTitle("Data nn>0.1")
-    h_data10.SetLineWidth(2)
-    h_data10.SetLineColor(3)
-    hs.Add(h_data10, "histo")
-
-    t_data.Draw("Sum$(data20.energy*(data20.layer == 0))>>h_data20(200, 0, 3)", "Sum$(data20.energy*(data20.layer == 0)) > 0")
-    h_data20 = gROOT.FindObject("h_data20")
-    h_data20.SetTitle("Data nn>0.2")
-    h_data20.SetLineWidth(2)
-    h_data20.SetLineColor(4)
-    hs.Add(h_data20, "histo")
-
-    t_data.Draw("Sum$(energy*(layer == 0))>>h_data50(200, 0, 3)", "Sum$(energy*(layer == 0)) > 0")
-    h_data50 = gROOT.FindObject("h_data50")
-    h_data50.SetTitle("Data nn>0.5")
-    h_data50.SetLineWidth(2)
-    h_data50.SetLineColor(1)
-    hs.Add(h_data50, "histo")
-
-    t_data.Draw("Sum$(data90.energy*(data90.layer == 0))>>h_data90(200, 0, 3)", "Sum$(data90.energy*(data90.layer == 0)) > 0")
-    h_data90 = gROOT.FindObject("h_data90")
-    h_data90.SetTitle("Data nn>0.90")
-    h_data90.SetLineWidth(2)
-    h_data90.SetLineColor(5)
-    hs.Add(h_data90, "histo")
-
-    t_data.Draw("Sum$(data99.energy*(data99.layer == 0))>>h_data99(200, 0, 3)", "Sum$(data99.energy*(data99.layer == 0)) > 0")
-    h_data99 = gROOT.FindObject("h_data99")
-    h_data99.SetTitle("Data nn>0.99")
-    h_data99.SetLineWidth(2)
-    h_data99.SetLineColor(6)
-    hs.Add(h_data99, "histo")
+    h_data = []
+    for nn, title, color in ((10, "0.1", 3), (20, "0.2", 4), (50, "0.5", 1), (90, "0.90", 5), (99, "0.99", 6)):
+        energy = "Sum$(energy*(layer == 0)*(nn_output >= {}))".format(nn / 100.)
+        t_data.Draw("{}>>h_data{}(200, 0, 3)".format(energy, nn), "{} > 0".format(energy))
+        h = gROOT.FindObject("h_data{}".format(nn))
+        h.SetTitle("Data nn>" + title)
+        h.SetLineWidth(2)
+        h.SetLineColor(color)
+        hs.Add(h, "histo")
+        h_data.append(h)
 
     # t_mc.Draw("Sum$(tr1_energy/0.0885)>>h_mc(200, 0, 3)", "Sum$(tr1_energy/0.0885) > 0")
     # h_mc = gROOT.FindObject("h_mc")
@@ -0,0 +1,146 @@
+'''
+Conversion of APV channels to pads.
+ApvMaps keeps the channel to pad maps of each APV type. Out of them a single
+(16, 128) table (apv_id, apv_ch) -> sector, pad, layer is built once and saved
+next to the APV calibration files. The table can be indexed with whole arrays
+of APV ids and channels.
+'''
+
+import numpy as np
+import os.path
+
+
+# This converts channel number to pad number. For example:
+# ApvMaps.tb16_master_divider[0] -- channel 0 is grounded. Not connected to any pad
+# ApvMaps.tb16_master_divider[1] -- channel 1 is connected to pad 255 (see scheme in signals_selection.py).
+
+class ApvMaps:
+    '''Define channel to pad conversion'''
+    tb15_master = [190 - i if i < 63 else i + 129 for i in range(127)] + [-1]
+
+    tb15_slave = [-1, 62, 63, 60, 61, 58, 59, 56, 57, 54, 55, 52, 53, 50, 51,
+                  48, 49, 46, 47, 44, 45, 42, 43, 40, 41, 38, 39, 36, 37, 34,
+                  35, 32, 33, 30, 31, 28, 29, 26, 27, 24, 25, 22, 23, 20, 21,
+                  18, 19, 16, 17, 14, 15, 12, 13, 10, 11, 8, 9, 6, 7, 4, 5,
+                  2, 3, 0, 1, 65, 64, 67, 66, 69, 68, 71, 70, 73, 72, 75, 74,
+                  77, 76, 79, 78, 81, 80, 83, 82, 85, 84, 87, 86, 89, 88, 91,
+                  90, 93, 92, 95, 94, 97, 96, 99, 98, 101, 100, 103, 102, 105,
+                  104, 107, 106, 109, 108, 111, 110, 113, 112, 115, 114, 117,
+                  116, 119, 118, 121, 120, 123, 122, 125, 124, 127]
+
+    tb16_master_divider = [-1, 255, 254, 253, 252, 251, 250, 249, 248, 247, 246,
+                           245, 244, 243, 242, 241, 240, 239, 238, 237, 236, 235,
+                           234, 233, 232, 231, 230, 229, 228, 227, 226, 225, 224,
+                           223, 222, 221, 220, 219, 218, 217, 216, 215, 214, 213,
+                           212, 211, 210, 209, 208, 207, 206, 205, 204, 203, 202,
+                           201, 200, 199, 198, 197, 196, 195, 194, 193, 192, 128,
+                           129, 130, 131, 132, 133, 134, 135, 136, 137, 138, 139,
+                           140, 141, 142, 143, 144, 145, 146, 147, 148, 149, 150,
+                           151, 152, 153, 154, 155, 156, 157, 158, 159, 160, 161,
+                           162, 163, 164, 165, 166, 167, 168, 169, 170, 171, 172,
+                           173, 174, 175, 176, 177, 178, 179, 180, 181, 182, 183,
+                           184, 185, 186, 187, 188, 189, 191]
+
+    tb16_slave_divider = [126, 124, 125, 122, 123, 120, 121, 118, 119, 116, 117,
+                          114, 115, 112, 113, 110, 111, 108, 109, 106, 107, 104,
+                          105, 102, 103, 100, 101, 98, 99, 96, 97, 94, 95, 92, 93,
+                          90, 91, 88, 89, 86, 87, 84, 85, 82, 83, 80, 81, 78, 79, 76,
+                          77, 74, 75, 72, 73, 70, 71, 68, 69, 66, 67, 64, 65, 1, 0, 3,
+                          2, 5, 4, 7, 6, 9, 8, 11, 10, 13, 12, 15, 14, 17, 16, 19, 18,
+                          21, 20, 23, 22, 25, 24, 27, 26, 29, 28, 31, 30, 33, 32, 35,
+                          34, 37, 36, 39, 38, 41, 40, 43, 42, 45, 44, 47, 46, 49, 48,
+                          51, 50, 53, 52, 55, 54, 57, 56, 59, 58, 61, 60, 63, 62, -1]
+
+    tb16_master_tab_divider = [191, 189, 188, 187, 186, 185, 184, 183, 182, 181, 180,
+                               179, 178, 177, 176, 175, 174, 173, 172, 171, 170, 169,
+                               168, 167, 166, 165, 164, 163, 162, 161, 160, 159, 158,
+                               157, 156, 155, 154, 153, 152, 151, 150, 149, 148, 147,
+                               146, 145, 144, 143, 142, 141, 140, 139, 138, 137, 136,
+                               135, 134, 133, 132, 131, 130, 129, 128, 192, 193, 194,
+                               195, 196, 197, 198, 199, 200, 201, 202, 203, 204, 205,
+                               206, 207, 208, 209, 210, 211, 212, 213, 214, 215, 216,
+                               217, 218, 219, 220, 221, 222, 223, 224, 225, 226, 227,
+                               228, 229, 230, 231, 232, 233, 234, 235, 236, 237, 238,
+                               239, 240, 241, 242, 243, 244, 245, 246, 247, 248, 249,
+                               250, 251, 252, 253, 254, 255, -1]
+
+    tb16_slave_tab_divider = [126, 124, 125, 122, 123, 120, 121, 118, 119, 116, 117,
+                              114, 115, 112, 113, 110, 111, 108, 109, 106, 107, 104,
+                              105, 102, 103, 100, 101, 98, 99, 96, 97, 94, 95, 92, 93,
+                              90, 91, 88, 89, 86, 87, 84, 85, 82, 83, 80, 81, 78, 79,
+                              76, 77, 74, 75, 72, 73, 70, 71, 68, 69, 66, 67, 64, 65,
+                              1, 0, 3, 2, 5, 4, 7, 6, 9, 8, 11, 10, 13, 12, 15, 14,
+                              17, 16, 19, 18, 21, 20, 23, 22, 25, 24, 27, 26, 29, 28,
+                              31, 30, 33, 32, 35, 34, 37, 36, 39, 38, 41, 40, 43, 42,
+                              45, 44, 47, 46, 49, 48, 51, 50, 53, 52, 55, 54, 57, 56,
+                              59, 58, 61, 60, 63, 62, -1]
+
+
+def choose_apv_map(apv_id):
+    """Return channel to pad map of the APV"""
+    if apv_id < 4:
+        return ApvMaps.tb15_slave if apv_id % 2 == 1 else ApvMaps.tb15_master
+    elif 4 <= apv_id < 14:
+        return ApvMaps.tb16_slave_divider if apv_id % 2 == 1 else ApvMaps.tb16_master_divider
+    elif apv_id == 14:
+        return ApvMaps.tb16_master_tab_divider
+    elif apv_id == 15:
+        return ApvMaps.tb16_slave_tab_divider
+
+
+N_APVS = 16
+N_CHANNELS = 128
+
+# path to the table relative to the analysis directory
+CHANNEL_MAP_FILE = "../apv_calibration/channel_map.txt"
+
+
+class ChannelMap:
+    """
+    sector, pad, layer are (16, 128) arrays indexed with [apv_id, apv_ch].
+    Grounded channels have sector -1 and pad 63 (as -1 // 64 and -1 % 64).
+    """
+    def __init__(self, sector, pad, layer):
+        self.sector = sector
+        self.pad = pad
+        self.layer = layer
+
+    def position(self, apv_id, apv_ch):
+        """Return sector, pad, layer of the channels. Accepts ints or arrays"""
+        return self.sector[apv_id, apv_ch], self.pad[apv_id, apv_ch], self.layer[apv_id, apv_ch]
+
+
+def build_channel_map():
+    """Return ChannelMap made out of ApvMaps"""
+    channel_pad = np.array([choose_apv_map(apv_id) for apv_id in range(N_APVS)], dtype=np.int32)
+    layer = np.repeat(np.arange(N_APVS, dtype=np.int32) // 2, N_CHANNELS).reshape(N_APVS, N_CHANNELS)
+    return ChannelMap(channel_pad // 64, channel_pad % 64, layer)
+
+
+def write_channel_map(channel_map, path=CHANNEL_MAP_FILE):
+    with open(path, 'w') as f:
+        f.write("apv_id  apv_ch  sector  pad  layer\n")
+        for apv_id in range(N_APVS):
+            for apv_ch in range(N_CHANNELS):
+                sector, pad, layer = channel_map.position(apv_id, apv_ch)
+                f.write("%s  %s  %s  %s  %s\n" % (apv_id, apv_ch, sector, pad, layer))
+
+
+def load_channel_map(path=CHANNEL_MAP_FILE):
+    """Return ChannelMap read from the table file"""
+    if not os.path.exists(path):
+        raise FileNotFoundError("No channel map {}. Create it with: python apv_maps.py".format(path))
+    table = np.loadtxt(path, dtype=np.int32, skiprows=1)
+    sector = np.zeros((N_APVS, N_CHANNELS), dtype=np.int32)
+    pad = np.zeros((N_APVS, N_CHANNELS), dtype=np.int32)
+    layer = np.zeros((N_APVS, N_CHANNELS), dtype=np.int32)
+    apv_id, apv_ch = table[:, 0], table[:, 1]
+    sector[apv_id, apv_ch] = table[:, 2]
+    pad[apv_id, apv_ch] = table[:, 3]
+    layer[apv_id, apv_ch] = table[:, 4]
+    return ChannelMap(sector, pad, layer)
+
+
+if __name__ == "__main__":
+    write_channel_map(build_channel_map())
+    print("Channel map is written to", CHANNEL_MAP_FILE)
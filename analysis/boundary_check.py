@@ -0,0 +1,86 @@
+'''
+Validation of MC tracker hits.
+Checks that the true particle position of each hit is inside
+the rho/phi window of the hit's pad. Done on whole HitBatch arrays,
+counts and residual histograms are accumulated over the run
+and the summary is printed and written at the end.
+'''
+
+import numpy as np
+from geometry import pad_rho, sector_phi
+
+
+def truth_position(hits, misalignment=0.):
+    """Return rho, phi of true particle positions in the detector coord system"""
+    p_x = -hits.p_x
+    p_y = hits.p_y + 164.3 + misalignment
+    return np.sqrt(p_x**2 + p_y**2), np.arctan2(p_y, p_x)
+
+
+def inside_boundary(hits, misalignment=0., rho_window=0.9, phi_window=np.pi / 12):
+    """Return inside_rho, inside_phi masks of the hits"""
+    rho, phi = truth_position(hits, misalignment)
+    hit_rho = pad_rho(hits.pad)
+    hit_phi = sector_phi(hits.sector)
+    inside_rho = (hit_rho - rho_window < rho) & (rho < hit_rho + rho_window)
+    inside_phi = (hit_phi - phi_window < phi) & (phi < hit_phi + phi_window)
+    return inside_rho, inside_phi
+
+
+class BoundaryCheck:
+    """Accumulates boundary check results of HitBatch with MC truth"""
+    def __init__(self, misalignment=0., rho_window=0.9, phi_window=np.pi / 12):
+        self.misalignment = misalignment
+        self.rho_window = rho_window
+        self.phi_window = phi_window
+
+        self.n_hits = 0
+        self.n_inside_rho = 0
+        self.n_inside_phi = 0
+        self.n_inside = 0
+
+        # Residual histograms: true position - pad centre
+        self.rho_bins = np.linspace(-10., 10., 201)
+        self.phi_bins = np.linspace(-0.5, 0.5, 201)
+        self.rho_residuals = np.zeros(len(self.rho_bins) - 1, dtype=np.int64)
+        self.phi_residuals = np.zeros(len(self.phi_bins) - 1, dtype=np.int64)
+
+    def fill(self, hits):
+        if len(hits) == 0:
+            return
+        inside_rho, inside_phi = inside_boundary(hits, self.misalignment, self.rho_window, self.phi_window)
+        self.n_hits += len(hits)
+        self.n_inside_rho += int(inside_rho.sum())
+        self.n_inside_phi += int(inside_phi.sum())
+        self.n_inside += int((inside_rho & inside_phi).sum())
+
+        rho, phi = truth_position(hits, self.misalignment)
+        self.rho_residuals += np.histogram(rho - pad_rho(hits.pad), self.rho_bins)[0]
+        self.phi_residuals += np.histogram(phi - sector_phi(hits.sector), self.phi_bins)[0]
+
+    def add(self, other):
+        """Add counts and residuals of other BoundaryCheck, e.g. of another range of events"""
+        self.n_hits += other.n_hits
+        self.n_inside_rho += other.n_inside_rho
+        self.n_inside_phi += other.n_inside_phi
+        self.n_inside += other.n_inside
+        self.rho_residuals += other.rho_residuals
+        self.phi_residuals += other.phi_residuals
+
+    def summary(self):
+        def fraction(n):
+            return 100. * n / self.n_hits if self.n_hits else 0.
+        return ("Boundary check of {} tracker hits: inside rho window {:.2f}%,"
+                " inside phi window {:.2f}%, inside both {:.2f}%").format(
+                    self.n_hits, fraction(self.n_inside_rho),
+                    fraction(self.n_inside_phi), fraction(self.n_inside))
+
+    def write(self, path):
+        """Write summary and residual histograms into text file"""
+        with open(path, 'w') as f:
+            f.write("# " + self.summary() + "\n")
+            f.write("# residual  bin_low  bin_high  n_hits\n")
+            for name, bins, counts in (("rho", self.rho_bins, self.rho_residuals),
+                                       ("phi", self.phi_bins, self.phi_residuals)):
+                for low, high, n in zip(bins[:-1], bins[1:], counts):
+                    f.write("%s  %s  %s  %s\n" % (name, low, high, n))
@@ -2,6 +2,17 @@ import numpy as np
 from ROOT import TTree, TFile
 import array
 from scipy import special
+from instrumentation import PhaseTimer, profiled, profile_path
+import argparse
+
+parser = argparse.ArgumentParser(description=('Smearing and efficiency of calorimeter hits of MC'))
+parser.add_argument('--input', type=str, default="../trees_5gev_e/lucas_geocuts.root",
+                    help='Tree made with do_mc_geocuts.py')
+parser.add_argument('--output', type=str, default="../trees_5gev_e/lucas_geocuts_noise_cal_eff.root",
+                    help='Output friend tree')
+parser.add_argument('--profile', action='store_true',
+                    help='Profile the event loop with cProfile, stats are written into <output>.prof')
+args = parser.parse_args()
 
 f=open("./noise.txt", "r")
 lines = f.readlines()
@@ -15,10 +26,10 @@ for line in lines[1:]:
     layer = int(values[2])
     noise[sector, pad, layer] = float(values[3])
 
-f_input = TFile.Open("../trees_5gev_e/lucas_geocuts.root", 'read')
+f_input = TFile.Open(args.input, 'read')
 t_input = f_input.lumical
 
-f_output = TFile.Open("../trees_5gev_e/lucas_geocuts_noise_cal_eff.root", "RECREATE")
+f_output = TFile.Open(args.output, "RECREATE")
 t_output = TTree('lumical', 'MC smeared')
 
 cal_n_hits_new = array.array('i', [0])
@@ -28,38 +39,44 @@ t_output.Branch('cal_n_hits_new', cal_n_hits_new, 'cal_n_hits_new/I')
 t_output.Branch('cal_energy_new', cal_energy_new, 'cal_energy_new[cal_n_hits_new]/F')
 
 
-for idx, event in enumerate(t_input):
-    if (idx % 1000) == 0:
-        print("Event: ", idx)
-    if idx == 100000:
-        break
+timer = PhaseTimer(min(t_input.GetEntries(), 100000))
+with profiled(profile_path(args.output) if args.profile else None):
+    for idx, event in enumerate(timer.iterate('read', t_input)):
+        if idx == 100000:
+            break
 
-    n_hits = event.cal_n_hits
-    j = 0
-    for i in range(n_hits):
-        sector = event.cal_hit_sector[i]
-        pad = event.cal_hit_pad[i]
-        layer = event.cal_hit_layer[i]
-        energy = event.cal_hit_energy[i]
-        rand_noise = np.random.normal(0., 0.7*noise[sector][pad][layer])
-        energy_smeared = energy + rand_noise
-        if energy_smeared <= 0:
-            continue
-        # Itamar values
-        # S0_cal = 0.819
-        # p1_cal = 2.166
-        S0_cal = 2.
-        p1_cal = 3.3
-        p0 = 0.999 / 2.
-        # If hit is in calorimeter - reject hit with a probability based on efficiency curve
-        # measured for the paper
-        if np.random.random() > (1. + special.erf((energy_smeared/0.0885 - S0_cal) / p1_cal)) * p0:
-            continue
-        cal_energy_new[j] = energy_smeared
-        j +=1
-    cal_n_hits_new[0] = j
+        with timer.phase('smear') as phase:
+            n_hits = event.cal_n_hits
+            j = 0
+            for i in range(n_hits):
+                sector = event.cal_hit_sector[i]
+                pad = event.cal_hit_pad[i]
+                layer = event.cal_hit_layer[i]
+                energy = event.cal_hit_energy[i]
+                rand_noise = np.random.normal(0., 0.7*noise[sector][pad][layer])
+                energy_smeared = energy + rand_noise
+                if energy_smeared <= 0:
+                    continue
+                # Itamar values
+                # S0_cal = 0.819
+                # p1_cal = 2.166
+                S0_cal = 2.
+                p1_cal = 3.3
+                p0 = 0.999 / 2.
+                # If hit is in calorimeter - reject hit with a probability based on efficiency curve
+                # measured for the paper
+                if np.random.random() > (1. + special.erf((energy_smeared/0.0885 - S0_cal) / p1_cal)) * p0:
+                    continue
+                cal_energy_new[j] = energy_smeared
+                j +=1
+            cal_n_hits_new[0] = j
+            phase.count(1, n_hits)
 
-    t_output.Fill()
+        with timer.phase('write') as phase:
+            t_output.Fill()
+            phase.count(1)
+        timer.done(idx + 1)
 
 f_output.Write()
 f_output.Close()
+timer.summary()
@@ -0,0 +1,136 @@
+'''
+APV calibration. To convert Volts to MIPs.
+Calibration curves of all 16 APVs are kept as sorted numpy knot arrays,
+so whole arrays of (apv_id, signal) pairs are converted in one call.
+The evaluation reproduces TGraph::Eval linear interpolation and extrapolation.
+'''
+# path on alzt.tau.ac.il server = '/data/alzta/aborysov/tb_2016_data/code/lumical_clust/fcalib/'
+
+import numpy as np
+from itertools import islice
+
+
+N_APVS = 16
+
+# Calibration for tracker APVs are manualy scaled to match MC MPV hit energy
+SCALE_FACTORS = [19.54364863654917, 18.303542363112417,
+                 21.093676081159632, 20.77784418996082] + [19.206] * 12
+
+# Signals above this value are saturated
+SATURATION = 1450.
+
+
+def read_calibration_points(calib_file, scale):
+    """Return x, y, x_err, y_err arrays of the calibration curve"""
+    # 1st point
+    x = [0.]
+    y = [0.]
+    x_err = [1.e-5]
+    y_err = [1.e-5]
+
+    # Calibration x-y data is inverted
+    with open(calib_file, 'r') as file:
+        for line in islice(file, 1, None):
+            x.append(float(line.split('  ')[1]))
+            y.append(float(line.split('  ')[0]))
+            x_err.append(float(line.split('  ')[3]))
+            y_err.append(float(line.split('  ')[2]))
+
+    return np.array(x), np.array(y) * scale, np.array(x_err), np.array(y_err)
+
+
+def graph_neighbors(x, value):
+    """
+    Return (low, up) indices TGraph::Eval uses for the value
+    which is not equal to any of x. Copy of the loop in TGraph::Eval.
+    """
+    low, up, low2, up2 = -1, -1, -1, -1
+    for i in range(len(x)):
+        if x[i] < value:
+            if low == -1 or x[i] > x[low]:
+                low2 = low
+                low = i
+            elif low2 == -1:
+                low2 = i
+        elif x[i] > value:
+            if up == -1 or x[i] < x[up]:
+                up2 = up
+                up = i
+            elif up2 == -1:
+                up2 = i
+    if up == -1:
+        up = low
+        low = low2
+    if low == -1:
+        low = up
+        up = up2
+    return low, up
+
+
+class ApvCurve:
+    """Calibration curve of a single APV"""
+    def __init__(self, x, y):
+        # Knots sorted by x. TGraph takes the first point among equal x
+        self.x, first = np.unique(x, return_index=True)
+        self.y = y[first]
+
+        # TGraph returns the 1st point for NaN
+        self.y_nan = y[0]
+
+        # Outside of the curve TGraph extrapolates with points found by its
+        # loop, which depend on the order of the points, not only on their values
+        low, up = graph_neighbors(x, np.inf)
+        self.above = (x[low], y[low], x[up], y[up])
+        low, up = graph_neighbors(x, -np.inf)
+        self.below = (x[low], y[low], x[up], y[up])
+
+    def eval(self, value):
+        """Return calibrated values for an array of values"""
+        n_knots = len(self.x)
+        pos = np.searchsorted(self.x, value, side='left')
+        pos_clip = np.minimum(pos, n_knots - 1)
+        exact = (pos < n_knots) & (self.x[pos_clip] == value)
+
+        # Interpolation between the closest knots
+        low = np.clip(pos - 1, 0, n_knots - 1)
+        x_low, y_low = self.x[low], self.y[low]
+        x_up, y_up = self.x[pos_clip], self.y[pos_clip]
+
+        # Extrapolation
+        for outside, (x_l, y_l, x_u, y_u) in ((pos == 0, self.below), (pos == n_knots, self.above)):
+            x_low = np.where(outside, x_l, x_low)
+            y_low = np.where(outside, y_l, y_low)
+            x_up = np.where(outside, x_u, x_up)
+            y_up = np.where(outside, y_u, y_up)
+
+        # Same order of operations as in TGraph::Eval
+        with np.errstate(divide='ignore', invalid='ignore'):
+            result = y_up + (value - x_up) * (y_low - y_up) / (x_low - x_up)
+        result = np.where(x_low == x_up, y_low, result)
+        result = np.where(exact, self.y[pos_clip], result)
+        result = np.where(np.isnan(value), self.y_nan, result)
+        return result
+
+
+class ApvCalibration:
+    """Calibration curves of all APVs"""
+    def __init__(self, path="../apv_calibration/"):
+        self.curves = []
+        for i in range(N_APVS):
+            calib_file = path + "calibration_apv_{}".format(i) + ".txt"
+            x, y, _, _ = read_calibration_points(calib_file, SCALE_FACTORS[i])
+            self.curves.append(ApvCurve(x, y))
+
+    def eval(self, apv_id, value):
+        """Return calibrated values as TGraph::Eval does. Accepts numbers or arrays"""
+        apv_id, value = np.broadcast_arrays(np.asarray(apv_id), np.asarray(value, dtype=np.float64))
+        result = np.zeros(value.shape)
+        for i in np.unique(apv_id):
+            mask = apv_id == i
+            result[mask] = self.curves[i].eval(value[mask])
+        return result if result.ndim else float(result)
+
+    def energy(self, apv_id, signal):
+        """Return energy in MIP of the signals with saturation clamp"""
+        signal = np.asarray(signal, dtype=np.float64)
+        return self.eval(apv_id, np.where(signal < SATURATION, signal, SATURATION))
@@ -0,0 +1,66 @@
+'''
+Status of the detector channels.
+Geometrical cuts, bad pads and grounded channels are kept in one text file
+per run period (../apv_calibration/channel_status_<run period>.txt).
+It is loaded into a boolean (4, 64, 8) mask [sector, pad, layer],
+so hits are checked with one array lookup.
+'''
+
+import numpy as np
+import functools
+
+
+N_SECTORS = 4
+N_PADS = 64
+N_LAYERS = 8
+
+DEFAULT_RUN_PERIOD = "tb16"
+CHANNEL_STATUS_PATH = "../apv_calibration/"
+
+
+class ChannelStatus:
+    """bad is (4, 64, 8) mask, True if hits in the pad are rejected"""
+    def __init__(self, bad, grounded_bad):
+        self.bad = bad
+        self.grounded_bad = grounded_bad
+
+    def is_bad(self, sector, pad, layer):
+        """Return True if hit must be rejected. Accepts ints or arrays"""
+        if np.ndim(sector) == 0:
+            return self.grounded_bad if sector < 0 else bool(self.bad[sector, pad, layer])
+        sector = np.asarray(sector)
+        grounded = sector < 0
+        bad = self.bad[np.where(grounded, 0, sector), pad, layer]
+        return np.where(grounded, self.grounded_bad, bad)
+
+
+def read_channel_status(status_file):
+    """Return ChannelStatus read from the file"""
+    bad = np.zeros((N_SECTORS, N_PADS, N_LAYERS), dtype=bool)
+    grounded_bad = True
+    with open(status_file, 'r') as file:
+        for line in file:
+            values = line.split()
+            if not values or values[0].startswith('#'):
+                continue
+            key, numbers = values[0], [int(value) for value in values[1:]]
+            if key == 'min_pad':
+                bad[:, :numbers[0], :] = True
+            elif key == 'bad_sectors':
+                bad[numbers, :, :] = True
+            elif key == 'bad_layers':
+                bad[:, :, numbers] = True
+            elif key == 'grounded_bad':
+                grounded_bad = bool(numbers[0])
+            elif key == 'bad_pads':
+                layer, sector = numbers[0], numbers[1]
+                bad[sector, numbers[2:], layer] = True
+            else:
+                raise ValueError("Unknown key '{}' in {}".format(key, status_file))
+    return ChannelStatus(bad, grounded_bad)
+
+
+@functools.lru_cache(maxsize=None)
+def load_channel_status(run_period=DEFAULT_RUN_PERIOD, path=CHANNEL_STATUS_PATH):
+    """Return ChannelStatus of the run period. Files are read once"""
+    return read_channel_status(path + "channel_status_{}.txt".format(run_period))
@@ -0,0 +1,141 @@
+'''
+Scan of the calorimeter clustering parameters in one pass over the data.
+Towers, seeds and cluster hits are made once per event (make_cal_cluster_hits),
+then every parameter set of the grid does only the cluster positions and merging.
+Summary of each parameter set (n of clusters, leading cluster energy and position)
+is written into its own tree "sweep_<i>", the tree title keeps the parameters.
+Input is the output of "signals_selection.py" as for "extract_data.py".
+'''
+
+from ROOT import TFile, TTree
+import array
+import itertools
+from clustering import make_cal_cluster_hits, make_cal_clusters_from_hits
+from extract_data import make_hits_lists, hit_branches
+from columnar import ChunkReader
+from geometry import load_alignment
+from channel_status import load_channel_status, DEFAULT_RUN_PERIOD
+from instrumentation import PhaseTimer, count_chunk, profiled, profile_path
+
+import argparse
+
+
+PARAMETERS = ('log_weight', 'merge_distance', 'ratio_slope', 'max_distance')
+
+
+class SweepTree:
+    """Tree with clusters summary of one parameter set"""
+    def __init__(self, idx, params):
+        self.params = params
+        title = ' '.join('{}={}'.format(name, value) for name, value in params.items())
+        self.tree = TTree('sweep_{}'.format(idx), title)
+
+        self.n_clusters = array.array('i', [0])
+        self.energy = array.array('f', [0.0])
+        self.x = array.array('f', [0.0])
+        self.y = array.array('f', [0.0])
+        self.tree.Branch('n_clusters', self.n_clusters, 'n_clusters/I')
+        self.tree.Branch('energy', self.energy, 'energy/F')
+        self.tree.Branch('x', self.x, 'x/F')
+        self.tree.Branch('y', self.y, 'y/F')
+
+        # Totals for the summary print
+        self.sum_n_clusters = 0
+        self.sum_energy = 0.
+
+    def fill(self, clusters):
+        self.n_clusters[0] = len(clusters)
+        if clusters:
+            self.energy[0] = clusters[0].energy
+            self.x[0] = clusters[0].x
+            self.y[0] = clusters[0].y
+        else:
+            self.energy[0] = 0.
+            self.x[0] = -999.
+            self.y[0] = -999.
+        self.tree.Fill()
+
+        self.sum_n_clusters += len(clusters)
+        self.sum_energy += self.energy[0]
+
+
+def main(args):
+    input_file = TFile.Open(args.path_to_file, "READ")
+    input_tree = input_file.data
+    print("Total n events in loaded files: ", input_tree.GetEntries())
+    reader = ChunkReader(input_tree, {'hits': hit_branches(args.nn)}, chunk_size=args.chunk_size)
+
+    alignment = load_alignment(args.alignment)
+    channel_status = load_channel_status(args.run_period)
+
+    # Grid of the parameter sets
+    grid = [dict(zip(PARAMETERS, values)) for values in
+            itertools.product(args.log_weight, args.merge_distance, args.ratio_slope, args.max_distance)]
+    print("N parameter sets: ", len(grid))
+
+    # Create output root file before the tree!!! It prevents memory leakage
+    output_file = TFile(args.output, "RECREATE")
+    sweep_trees = [SweepTree(idx, params) for idx, params in enumerate(grid)]
+
+    n_events = len(reader)
+    timer = PhaseTimer(n_events)
+    with profiled(profile_path(args.output) if args.profile else None):
+        for chunk in timer.iterate('read', reader, count_chunk):
+            with timer.phase('hits') as phase:
+                _, _, batch_cal = make_hits_lists(chunk, channel_status, args.nn)
+                phase.count(chunk.n_entries, len(batch_cal))
+            with timer.phase('align') as phase:
+                alignment.apply(batch_cal)
+                phase.count(chunk.n_entries, len(batch_cal))
+
+            for hits_cal in batch_cal.events():
+                # Done once for all parameter sets
+                with timer.phase('towers') as phase:
+                    cluster_hits = make_cal_cluster_hits(hits_cal)
+                    phase.count(1, len(hits_cal))
+                for sweep_tree in sweep_trees:
+                    with timer.phase('cluster') as phase:
+                        clusters = make_cal_clusters_from_hits(cluster_hits, **sweep_tree.params)
+                        phase.count(1, len(hits_cal))
+                    with timer.phase('write') as phase:
+                        sweep_tree.fill(clusters)
+                        phase.count(1)
+            timer.done(chunk.first + chunk.n_entries)
+    timer.summary()
+
+    for sweep_tree in sweep_trees:
+        sweep_tree.tree.Write()
+    output_file.Close()
+
+    for idx, sweep_tree in enumerate(sweep_trees):
+        print('sweep_{}: {}; mean n clusters {:.3f}; mean leading energy {:.3f}'.format(
+            idx, sweep_tree.tree.GetTitle(),
+            sweep_tree.sum_n_clusters / max(n_events, 1), sweep_tree.sum_energy / max(n_events, 1)))
+    print("Hooray, sweep tree file is ready, take it :3")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=('Scan of calorimeter clustering parameters'))
+    parser.add_argument('path_to_file', type=str, help='Provide path to the root file')
+    parser.add_argument('--output', type=str, default='./cluster_sweep.root', help='Output root file')
+    parser.add_argument('--alignment', type=str, default='./alignment_data.txt',
+                        help='File with alignment transforms of each layer')
+    parser.add_argument('--nn', type=float, default=None,
+                        help='NN Cutoff on hits of the tree made with signals_selection.py --keep-nn')
+    parser.add_argument('--run-period', type=str, default=DEFAULT_RUN_PERIOD,
+                        help='Run period of the channel status file')
+    parser.add_argument('--chunk-size', type=int, default=10000,
+                        help='Number of events read at once')
+    parser.add_argument('--log-weight', type=float, nargs='+', default=[3.4],
+                        help='Cut-off of logarithmic weights')
+    parser.add_argument('--merge-distance', type=float, nargs='+', default=[7.5],
+                        help='Clusters closer in y (mm) are always merged')
+    parser.add_argument('--ratio-slope', type=float, nargs='+', default=[0.032],
+                        help='Merge if energy ratio < ratio_slope * (max_distance - distance)')
+    parser.add_argument('--max-distance', type=float, nargs='+', default=[20.],
+                        help='Max distance in y (mm) of the energy ratio merging')
+    parser.add_argument('--profile', action='store_true',
+                        help='Profile the event loop with cProfile, stats are written into <output>.prof')
+    args = parser.parse_args()
+
+    main(args)
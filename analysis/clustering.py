@@ -3,8 +3,11 @@ This file does clustering to the hits in calorimeter.
 '''
 
 import numpy as np
+import heapq
 import os.path
 from itertools import product
+from hit import HitBatch
+from geometry import N_SECTORS, N_PADS
 from ROOT import TCanvas, TH2F, gStyle, TColor
 
 
@@ -13,137 +16,379 @@ class Tower:
     Each tower object has "seed" for the number of the cluster
     it is assigned to.
     '''
-    def __init__(self, tower_hits):
-        self.hits = tower_hits
-        self.sector = tower_hits[0].sector
-        self.pad = tower_hits[0].pad
-        self.energy = sum(hit.energy for hit in tower_hits)
-        self.n_pads = len(tower_hits)
+    def __init__(self, hits, hit_idx):
+        # Indices of the tower hits in the event HitBatch
+        self.hit_idx = hit_idx
+        self.sector = int(hits.sector[hit_idx[0]])
+        self.pad = int(hits.pad[hit_idx[0]])
+        self.energy = sum(hits.energy[hit_idx].tolist())
+        self.n_pads = len(hit_idx)
 
         self.seed = -1
 
 
-def make_towers_list(hits_list):
-    """Return list of towers objects out of hits list"""
-    towers_pos = set((hit.sector, hit.pad) for hit in hits_list)
-    towers = []
-    for pos in towers_pos:
-        tower_hits = [hit for hit in hits_list if (hit.sector, hit.pad) == pos]
-        towers.append(Tower(tower_hits))
+class Towers:
+    '''
+    Towers of one or many events kept as arrays, sorted by energy within each event.
+    Towers of event i are [offsets[i]:offsets[i + 1]].
+    Hits of tower j are hit_idx[hit_offsets[j]:hit_offsets[j + 1]],
+    indices in the HitBatch the towers are made of.
+    '''
+    def __init__(self, sector, pad, energy, n_pads, offsets, hit_idx, hit_offsets):
+        self.sector = sector
+        self.pad = pad
+        self.energy = energy
+        self.n_pads = n_pads
+        self.offsets = offsets
+        self.hit_idx = hit_idx
+        self.hit_offsets = hit_offsets
+
+    def __len__(self):
+        return len(self.sector)
+
+    def tower_hits(self, j):
+        """Return indices of the hits of tower j"""
+        return self.hit_idx[self.hit_offsets[j]:self.hit_offsets[j + 1]]
+
+
+def set_order(sector, pad):
+    """Return (sector, pad) of the event towers in iteration order of the python set"""
+    return list(set(zip(sector.tolist(), pad.tolist())))
+
+
+def make_towers(hits):
+    """Return Towers of all events of HitBatch.
+    Energies and number of pads are summed on dense (n_events, 4, 64) grid.
+    Order is the same as sorting the set of tower positions by energy
+    """
+    n_cells = N_SECTORS * N_PADS
+    n_events = hits.n_events
+    cell = hits.event_index() * n_cells + hits.sector.astype(np.int64) * N_PADS + hits.pad
+    # bincount adds hits in the same order as sum() over the tower hits
+    energy_grid = np.bincount(cell, weights=hits.energy, minlength=n_events * n_cells)
+    n_pads_grid = np.bincount(cell, minlength=n_events * n_cells)
+
+    tower_cell = np.flatnonzero(n_pads_grid)
+    tower_event = tower_cell // n_cells
+    energy = energy_grid[tower_cell]
+    order = np.lexsort((-energy, tower_event))
+    tower_cell = tower_cell[order]
+    tower_event = tower_event[order]
+    energy = energy[order]
+
+    offsets = np.zeros(n_events + 1, dtype=np.int64)
+    np.cumsum(np.bincount(tower_event, minlength=n_events), out=offsets[1:])
+
+    # Towers with equal energy are kept in the set order
+    ties = (energy[1:] == energy[:-1]) & (tower_event[1:] == tower_event[:-1])
+    for event in np.unique(tower_event[1:][ties]):
+        begin, end = offsets[event], offsets[event + 1]
+        hits_begin, hits_end = hits.offsets[event], hits.offsets[event + 1]
+        cells = [event * n_cells + sector * N_PADS + pad for sector, pad in
+                 set_order(hits.sector[hits_begin:hits_end], hits.pad[hits_begin:hits_end])]
+        cells = np.array(cells, dtype=np.int64)
+        cells = cells[np.argsort(-energy_grid[cells], kind='stable')]
+        tower_cell[begin:end] = cells
+        energy[begin:end] = energy_grid[cells]
+
+    # Hits grouped by tower, in the original order inside each tower
+    tower_of_cell = np.full(n_events * n_cells, -1, dtype=np.int64)
+    tower_of_cell[tower_cell] = np.arange(len(tower_cell))
+    hit_idx = np.argsort(tower_of_cell[cell], kind='stable')
+    n_pads = n_pads_grid[tower_cell]
+    hit_offsets = np.zeros(len(tower_cell) + 1, dtype=np.int64)
+    np.cumsum(n_pads, out=hit_offsets[1:])
+
+    sector_pad = tower_cell % n_cells
+    return Towers(sector_pad // N_PADS, sector_pad % N_PADS, energy, n_pads,
+                  offsets, hit_idx, hit_offsets)
+
+
+def make_towers_list(hits):
+    """Return list of towers objects out of event HitBatch sorted by energy"""
+    towers = make_towers(hits)
+    return [Tower(hits, towers.tower_hits(j)) for j in range(len(towers))]
+
+
+def find_seeds(sector, pad, energy, offsets, candidates=None):
+    """Return seed number of each tower or hit, -1 if it is not a seed.
+    Seed is a local maximum: no neighbor in 3 x 3 (sector, pad) window has strictly greater energy.
+    Only candidates (mask) can be seeds. Seeds are numbered in the given order within each event.
+    Neighborhood maximum is done on the dense (n_events, 4, 64) grid padded with -inf.
+    """
+    n_events = len(offsets) - 1
+    event = np.repeat(np.arange(n_events), np.diff(offsets))
+    grid = np.full((n_events, N_SECTORS + 2, N_PADS + 2), -np.inf)
+    # fmax ignores NaN energies as the "greater than" check does
+    np.fmax.at(grid, (event, sector + 1, pad + 1), energy)
 
-    # Sort towers by energy
-    towers.sort(key=lambda x: x.energy, reverse=True)
+    # 3 x 3 maximum filter done separately along pads and sectors
+    grid = np.fmax(np.fmax(grid[:, :, :-2], grid[:, :, 1:-1]), grid[:, :, 2:])
+    grid = np.fmax(np.fmax(grid[:, :-2, :], grid[:, 1:-1, :]), grid[:, 2:, :])
 
-    return towers
+    is_seed = ~(grid[event, sector, pad] > energy)
+    if candidates is not None:
+        is_seed &= candidates
+
+    n_seeds_before = np.zeros(n_events + 1, dtype=np.int64)
+    np.cumsum(np.bincount(event[is_seed], minlength=n_events), out=n_seeds_before[1:])
+    seeds = np.cumsum(is_seed) - 1 - n_seeds_before[event]
+    return np.where(is_seed, seeds, -1)
 
 
 def set_tower_seeds(towers_list):
     """Assign cluster indices to the towers. Make towers seeds"""
-    seed_idx = 0
-    for tower in towers_list:
-        if tower.n_pads == 1:
+    sector = np.array([tower.sector for tower in towers_list], dtype=np.int64)
+    pad = np.array([tower.pad for tower in towers_list], dtype=np.int64)
+    energy = np.array([tower.energy for tower in towers_list], dtype=np.float64)
+    n_pads = np.array([tower.n_pads for tower in towers_list], dtype=np.int64)
+
+    # Local maximum with more than 1 pad.
+    seeds = find_seeds(sector, pad, energy, [0, len(towers_list)], n_pads != 1)
+    for tower, seed in zip(towers_list, seeds.tolist()):
+        tower.seed = seed
+
+
+def make_neighbors(sector, pad):
+    """Return function giving towers or hits within radius r around item i on the (sector, pad) grid"""
+    items_at = [[[] for _ in range(N_PADS)] for _ in range(N_SECTORS)]
+    for i, (s, p) in enumerate(zip(sector, pad)):
+        items_at[s][p].append(i)
+
+    def neighbors(i, r):
+        for s in range(max(sector[i] - r, 0), min(sector[i] + r + 1, N_SECTORS)):
+            for items in items_at[s][max(pad[i] - r, 0):pad[i] + r + 1]:
+                for j in items:
+                    if j != i:
+                        yield j
+    return neighbors
+
+
+def spread_seeds(seeds, energy, neighbors, r, queue):
+    """Assign seeds in place to all items connected to assigned ones by neighbors within radius r.
+    Same as sweeping items in their order and giving each item the seed of
+    its most energetic assigned neighbor until nothing changes.
+    Here the item is assigned when its neighbor is, in the order of (sweep, position)
+    the sweeps would reach it, taken from the priority queue.
+    queue has (1, i) of the items with assigned neighbors before the first sweep.
+    """
+    heapq.heapify(queue)
+    while queue:
+        sweep, i = heapq.heappop(queue)
+        if seeds[i] != -1:
             continue
-        sector = tower.sector
-        pad = tower.pad
-
-        # Check if it is local maximum
-        for tower_neighbor in towers_list:
-            if (tower_neighbor.sector in range(sector - 1, sector + 2)
-               and tower_neighbor.pad in range(pad - 1, pad + 2)
-               and tower_neighbor.energy > tower.energy):
-                break
-        else:
-            # This is local maximum with more than 1 pad.
-            tower.seed = seed_idx
-            seed_idx += 1
+        # Most energetic assigned neighbor, the first one in the order if equal
+        best = -1
+        for j in neighbors(i, r):
+            if seeds[j] != -1 and (best == -1 or energy[j] > energy[best]
+                                   or (energy[j] == energy[best] and j < best)):
+                best = j
+        seeds[i] = seeds[best]
+
+        # Neighbors after this item are reached in the same sweep, before it in the next one
+        for j in neighbors(i, r):
+            if seeds[j] == -1:
+                heapq.heappush(queue, (sweep if j > i else sweep + 1, j))
+
+
+def grow_clusters(sector, pad, energy, seeds):
+    """Return seeds of all towers of one event sorted by energy. Not seed towers are assigned to clusters.
+    Towers connected to seeds within radius r = 1 are assigned first (spread_seeds),
+    then r += 1 for the rest until all are assigned.
+    """
+    seeds = list(seeds)
+    n_towers = len(seeds)
+    if all(seed == -1 for seed in seeds):
+        return seeds
+    sector = sector.tolist()
+    pad = pad.tolist()
+    energy = energy.tolist()
+    neighbors = make_neighbors(sector, pad)
+
+    r = 1
+    while True:
+        unassigned = np.array([i for i in range(n_towers) if seeds[i] == -1], dtype=np.int64)
+        if not len(unassigned):
+            break
+        assigned = np.array([i for i in range(n_towers) if seeds[i] != -1], dtype=np.int64)
+        # Radii without any new neighbors change nothing, skip to the nearest one
+        distance = np.maximum(
+            np.abs(np.subtract.outer(np.take(sector, unassigned), np.take(sector, assigned))),
+            np.abs(np.subtract.outer(np.take(pad, unassigned), np.take(pad, assigned)))).min(axis=1)
+        r = max(r, int(distance.min()))
+
+        spread_seeds(seeds, energy, neighbors, r, [(1, i) for i in unassigned[distance <= r].tolist()])
+        r += 1
+    return seeds
 
 
 # Assign others not seed towers towers to clusters
 def find_neighbor_assign_cluster(towers_list):
-    if not any(tower.seed != -1 for tower in towers_list):
-        return
-    r = 1
-    while any(tower.seed == -1 for tower in towers_list):
-        changing = True
-        while changing:
-            changing = False
-            for tower in towers_list:
-                # plot_sensor_clusters(towers_list)
-                if tower.seed != -1:
-                    continue
-                sector = tower.sector
-                pad = tower.pad
-
-                neighbors = []
-                for tower_neighbor in towers_list:
-                    if (tower_neighbor.sector in range(sector - r, sector + r + 1)
-                       and tower_neighbor.pad in range(pad - r, pad + r + 1)
-                       and tower_neighbor.seed != -1):
-                        neighbors.append(tower_neighbor)
-
-                # It has neighbors assigned to the cluster
-                if len(neighbors) > 0:
-                    neighbors.sort(key=lambda x: x.energy, reverse=True)
-                    tower.seed = neighbors[0].seed
-                    changing = True
-        r += 1
+    sector = np.array([tower.sector for tower in towers_list], dtype=np.int64)
+    pad = np.array([tower.pad for tower in towers_list], dtype=np.int64)
+    energy = np.array([tower.energy for tower in towers_list], dtype=np.float64)
+    seeds = grow_clusters(sector, pad, energy, [tower.seed for tower in towers_list])
+    for tower, seed in zip(towers_list, seeds):
+        tower.seed = seed
+
+
+class ClusterMoments:
+    '''
+    Energy and weighted mean sector, pad, layer, x, y of the cluster hits.
+    Done in one pass: hit coordinates are stacked into (5, n_hits) matrix times the weights.
+    Weights are hit energies if log_weight is None (trackers),
+    otherwise log_weight + log(E_i / E) cut at 0 (calorimeter).
+    As log_weight + log(E_i / E) = (log_weight - log(E)) + log(E_i), sums of the coordinates
+    and of the coordinates * log(E_i) are kept, so two clusters are merged without
+    their hits if no weight of the merged cluster is cut.
+    '''
+    def __init__(self, hits, log_weight=3.4):
+        self.log_weight = log_weight
+        self.n_pads = len(hits)
+        # Added one by one in the hit order as python sum() and np.bincount do
+        self.energy = np.cumsum(hits.energy)[-1] if self.n_pads else 0.
+        coordinates = np.stack((hits.sector, hits.pad, hits.layer, hits.x, hits.y)).astype(np.float64)
+
+        if log_weight is None:
+            weights = hits.energy
+        else:
+            log_energy = np.log(hits.energy)
+            self.min_log_energy = log_energy.min() if self.n_pads else np.inf
+            self.sum_of_log_energy = log_energy.sum()
+            self.sums = coordinates.sum(axis=1)
+            self.log_energy_sums = coordinates @ log_energy
+
+            weights = log_weight + np.log(hits.energy / self.energy)
+            # Same as max(0, weight), which gives 0 for NaN
+            weights = np.where(weights > 0, weights, 0.)
+        self.weighted_sums = coordinates @ weights
+        self.sum_of_weights = weights.sum()
+
+    def merge(self, other):
+        """Add moments of the other cluster.
+        Return False if weights are cut and the merged cluster has to be done from its hits
+        """
+        energy = self.energy + other.energy
+        if self.log_weight is None:
+            self.energy = energy
+            self.n_pads += other.n_pads
+            self.weighted_sums = self.weighted_sums + other.weighted_sums
+            self.sum_of_weights = energy
+            return True
+
+        min_log_energy = min(self.min_log_energy, other.min_log_energy)
+        offset = self.log_weight - np.log(energy)
+        if not offset + min_log_energy > 0:
+            return False
+
+        self.energy = energy
+        self.n_pads += other.n_pads
+        self.min_log_energy = min_log_energy
+        self.sum_of_log_energy += other.sum_of_log_energy
+        self.sums = self.sums + other.sums
+        self.log_energy_sums = self.log_energy_sums + other.log_energy_sums
+        self.weighted_sums = offset * self.sums + self.log_energy_sums
+        self.sum_of_weights = offset * self.n_pads + self.sum_of_log_energy
+        return True
+
+    def mean(self):
+        """Return weighted mean sector, pad, layer, x, y. -999 if sum of weights is 0"""
+        if self.sum_of_weights != 0:
+            return tuple((self.weighted_sums / self.sum_of_weights).tolist())
+        return (-999,) * 5
 
 
 class CalCluster:
-    def __init__(self, cluster_hits, n_towers):
-        self.hits = cluster_hits
-        self.energy = sum(hit.energy for hit in cluster_hits)
+    def __init__(self, cluster_hits, n_towers, log_weight=3.4, hit_idx=None):
+        # HitBatches of the cluster hits, concatenated only when needed
+        self.hit_parts = [cluster_hits]
+        # Optional indices of the cluster hits in the event HitBatch
+        self.hit_idx = hit_idx
         self.n_towers = n_towers
-        self.n_pads = len(cluster_hits)
-
-        weights = [max(0, 3.4 + np.log(hit.energy / self.energy)) for hit in cluster_hits]
-        sum_of_weights = sum(weights)
-        if sum_of_weights != 0:
-            self.sector = sum(getattr(hit, "sector") * weight for hit, weight in zip(cluster_hits, weights)) / sum_of_weights
-            self.pad = sum(getattr(hit, "pad") * weight for hit, weight in zip(cluster_hits, weights)) / sum_of_weights
-            self.layer = sum(getattr(hit, "layer") * weight for hit, weight in zip(cluster_hits, weights)) / sum_of_weights
-            self.x = sum(getattr(hit, "x") * weight for hit, weight in zip(cluster_hits, weights)) / sum_of_weights
-            self.y = sum(getattr(hit, "y") * weight for hit, weight in zip(cluster_hits, weights)) / sum_of_weights
-        else:
-            self.sector = -999
-            self.pad = -999
-            self.layer = -999
-            self.x = -999
-            self.y = -999
+        self.moments = ClusterMoments(cluster_hits, log_weight)
+        self.set_position()
+
+    @property
+    def hits(self):
+        """HitBatch of the cluster hits"""
+        if len(self.hit_parts) > 1:
+            self.hit_parts = [HitBatch.concatenate(self.hit_parts)]
+        return self.hit_parts[0]
+
+    def set_position(self):
+        """Energy and logarithmically weighted position of the cluster"""
+        self.energy = self.moments.energy
+        self.n_pads = self.moments.n_pads
+        self.sector, self.pad, self.layer, self.x, self.y = self.moments.mean()
 
     def merge(self, cluster2):
-        self.hits.extend(cluster2.hits)
-        self.energy = sum(hit.energy for hit in self.hits)
+        self.hit_parts += cluster2.hit_parts
+        if self.hit_idx is not None and cluster2.hit_idx is not None:
+            self.hit_idx = np.concatenate([self.hit_idx, cluster2.hit_idx])
         self.n_towers += cluster2.n_towers
-        self.n_pads = len(self.hits)
-
-        weights = [max(0, 3.4 + np.log(hit.energy / self.energy)) for hit in self.hits]
-        sum_of_weights = sum(weights)
-        if sum_of_weights != 0:
-            self.sector = sum(getattr(hit, "sector") * weight for hit, weight in zip(self.hits, weights)) / sum_of_weights
-            self.pad = sum(getattr(hit, "pad") * weight for hit, weight in zip(self.hits, weights)) / sum_of_weights
-            self.layer = sum(getattr(hit, "layer") * weight for hit, weight in zip(self.hits, weights)) / sum_of_weights
-            self.x = sum(getattr(hit, "x") * weight for hit, weight in zip(self.hits, weights)) / sum_of_weights
-            self.y = sum(getattr(hit, "y") * weight for hit, weight in zip(self.hits, weights)) / sum_of_weights
-        else:
-            self.sector = -999
-            self.pad = -999
-            self.layer = -999
-            self.x = -999
-            self.y = -999
+        if not self.moments.merge(cluster2.moments):
+            self.moments = ClusterMoments(self.hits, self.moments.log_weight)
+        self.set_position()
+
+
+def merge_condition(clst1, clst2, merge_distance=7.5, ratio_slope=0.032, max_distance=20.):
+    """True if clst2 has to be merged into clst1"""
+    distance = abs(clst1.y - clst2.y)
+    ratio = clst2.energy / clst1.energy
+    return distance < merge_distance or (ratio < ratio_slope * (max_distance - distance))
 
 
-def merge_clusters(clusters_list):
+def merge_clusters(clusters_list, merge_distance=7.5, ratio_slope=0.032, max_distance=20.):
     """Merge pair of clusters if they meet following condition
     This is OPTIONAL. Working with TB20. First do the clustering without it!
+    Pairs are merged one by one, always the first pair in the (clst1, clst2) list order meeting the condition.
+    With positive energies the ratio condition needs distance < max_distance, so only clusters
+    inside this window in y are checked. Clusters already known to have no pair are
+    rechecked only against the cluster changed by the last merge.
     """
+    params = merge_distance, ratio_slope, max_distance
+    if not all(cluster.energy > 0 for cluster in clusters_list):
+        # Any pair may meet the condition
+        merge_clusters_all_pairs(clusters_list, *params)
+        return
+
+    window = max(merge_distance, max_distance) + 1.
+    no_pair = set()
+    while True:
+        y = np.array([cluster.y for cluster in clusters_list], dtype=np.float64)
+        y_order = np.argsort(y, kind='stable')
+        y_sorted = y[y_order]
+        for i, clst1 in enumerate(clusters_list):
+            if id(clst1) in no_pair:
+                continue
+            begin = np.searchsorted(y_sorted, y[i] - window, side='left')
+            end = np.searchsorted(y_sorted, y[i] + window, side='right')
+            for j in np.sort(y_order[begin:end]).tolist():
+                clst2 = clusters_list[j]
+                if clst1 != clst2 and merge_condition(clst1, clst2, *params):
+                    break
+            else:
+                no_pair.add(id(clst1))
+                continue
+            clst1.merge(clst2)
+            clusters_list.remove(clst2)
+            no_pair.discard(id(clst1))
+            # Clusters without a pair may now have one only with the changed cluster
+            for cluster in clusters_list:
+                if id(cluster) in no_pair and cluster != clst1 and merge_condition(cluster, clst1, *params):
+                    no_pair.discard(id(cluster))
+            break
+        else:
+            break
+
+
+def merge_clusters_all_pairs(clusters_list, merge_distance=7.5, ratio_slope=0.032, max_distance=20.):
+    """Same as merge_clusters, checking all pairs after each merge"""
     while True:
         for clst1, clst2 in product(clusters_list, clusters_list):
             if clst1 == clst2:
                 continue
-            distance = abs(clst1.y - clst2.y)
-            ratio = clst2.energy / clst1.energy
-            if distance < 7.5 or (ratio < 0.032 * (20. - distance)):
+            if merge_condition(clst1, clst2, merge_distance, ratio_slope, max_distance):
                 clst1.merge(clst2)
                 clusters_list.remove(clst2)
                 break
@@ -151,107 +396,93 @@ def merge_clusters(clusters_list):
             break
 
 
-# This is the main function which does everything.
-def make_cal_clusters(hits_list):
-    """Return cluster list out of towers list"""
-
-    towers_list = make_towers_list(hits_list)
+def make_cal_cluster_hits(hits):
+    """Return list of (HitBatch, n_towers) of the clusters before merging. Does not depend on cluster parameters"""
+    towers = make_towers(hits)
 
     # This part manages clustering for the calorimeter
-    set_tower_seeds(towers_list)
-    find_neighbor_assign_cluster(towers_list)
+    # Local maxima with more than 1 pad are seeds
+    seeds = find_seeds(towers.sector, towers.pad, towers.energy, towers.offsets, towers.n_pads != 1)
+    seeds = np.array(grow_clusters(towers.sector, towers.pad, towers.energy, seeds), dtype=np.int64)
 
-    clusters = []
-    if not towers_list:
-        return clusters
+    cluster_hits = []
+    if not len(towers):
+        return cluster_hits
 
-    n_clusters = max(tower.seed for tower in towers_list) + 1
+    n_clusters = seeds.max() + 1
     for i in range(n_clusters):
-        cluster_hits = []
-        n_towers = 0
-        for tower in towers_list:
-            if tower.seed == i:
-                n_towers += 1
-                cluster_hits.extend(tower.hits)
-        clusters.append(CalCluster(cluster_hits, n_towers))
+        cluster_towers = np.flatnonzero(seeds == i)
+        hit_idx = np.concatenate([towers.tower_hits(j) for j in cluster_towers])
+        cluster_hits.append((hits.take(hit_idx), len(cluster_towers)))
+    return cluster_hits
+
+
+def make_cal_clusters_from_hits(cluster_hits, log_weight=3.4, merge_distance=7.5, ratio_slope=0.032, max_distance=20.):
+    """Return merged cluster list out of make_cal_cluster_hits output"""
+    clusters = [CalCluster(hits, n_towers, log_weight) for hits, n_towers in cluster_hits]
 
     clusters.sort(key=lambda x: x.energy, reverse=True)
 
     # Comment here to exclude merging.
-    merge_clusters(clusters)
+    merge_clusters(clusters, merge_distance, ratio_slope, max_distance)
 
     clusters.sort(key=lambda x: x.energy, reverse=True)
 
     return clusters
 
 
+# This is the main function which does everything.
+def make_cal_clusters(hits, log_weight=3.4, merge_distance=7.5, ratio_slope=0.032, max_distance=20.):
+    """Return cluster list out of event HitBatch.
+    log_weight is the cut-off of logarithmic weights, others are parameters of merge_clusters
+    """
+    return make_cal_clusters_from_hits(make_cal_cluster_hits(hits), log_weight,
+                                       merge_distance, ratio_slope, max_distance)
+
+
 class TrCluster:
     def __init__(self, cluster_hits):
+        # HitBatch of the cluster hits
         self.hits = cluster_hits
-        self.n_pads = len(cluster_hits)
-
-        weights = [hit.energy for hit in cluster_hits]
-        self.energy = sum(weights)
-        if self.energy != 0:
-            self.sector = sum(getattr(hit, "sector") * weight for hit, weight in zip(cluster_hits, weights)) / self.energy
-            self.pad = sum(getattr(hit, "pad") * weight for hit, weight in zip(cluster_hits, weights)) / self.energy
-            self.x = sum(getattr(hit, "x") * weight for hit, weight in zip(cluster_hits, weights)) / self.energy
-            self.y = sum(getattr(hit, "y") * weight for hit, weight in zip(cluster_hits, weights)) / self.energy
-        else:
-            self.sector = -999
-            self.pad = -999
-            self.x = -999
-            self.y = -999
-
-
-def make_tr_clusters(hits_list):
-    seed_idx = 0
-    for hit in hits_list:
-        sector = hit.sector
-        pad = hit.pad
-
-        # Check if it is local maximum
-        for hit_neighbor in hits_list:
-            if (hit_neighbor.sector in range(sector - 1, sector + 2)
-               and hit_neighbor.pad in range(pad - 1, pad + 2)
-               and hit_neighbor.energy > hit.energy):
-                break
-        else:
-            # This is local maximum.
-            hit.seed = seed_idx
-            seed_idx += 1
+        # Energy weighted position
+        moments = ClusterMoments(cluster_hits, log_weight=None)
+        self.n_pads = moments.n_pads
+        self.energy = moments.energy
+        self.sector, self.pad, _, self.x, self.y = moments.mean()
 
-    while any(hit.seed == -1 for hit in hits_list):
-        for hit in hits_list:
-            if hit.seed != -1:
-                continue
 
-            sector = hit.sector
-            pad = hit.pad
+def assign_tr_hits(sector, pad, energy, seeds):
+    """Return seeds of all hits of tracker plane event. Not seed hits get the seed of the most energetic neighbor.
+    Seeded connected component labelling: seeds spread to the 3 x 3 neighbors (spread_seeds).
+    Every not seed hit has a more energetic neighbor, so it is connected to some seed.
+    """
+    seeds = list(seeds)
+    sector = sector.tolist()
+    pad = pad.tolist()
+    energy = energy.tolist()
+    neighbors = make_neighbors(sector, pad)
+
+    queue = [(1, i) for i in range(len(seeds)) if seeds[i] == -1
+             and any(seeds[j] != -1 for j in neighbors(i, 1))]
+    spread_seeds(seeds, energy, neighbors, 1, queue)
+    return seeds
 
-            neighbors = []
-            for hit_neighbor in hits_list:
-                if (hit_neighbor.sector in range(sector - 1, sector + 2)
-                   and hit_neighbor.pad in range(pad - 1, pad + 2)
-                   and hit_neighbor.seed != -1):
-                    neighbors.append(hit_neighbor)
 
-            # It has neighbors, check most energetic seed and assign
-            if len(neighbors) > 0:
-                neighbors.sort(key=lambda x: x.energy, reverse=True)
-                hit.seed = neighbors[0].seed
+def make_tr_clusters(hits):
+    """Return cluster list out of tracker plane event HitBatch"""
+    n_hits = len(hits)
+    # Local maxima
+    seeds = find_seeds(hits.sector, hits.pad, hits.energy, [0, n_hits])
+    seeds = assign_tr_hits(hits.sector, hits.pad, hits.energy, seeds)
 
     clusters = []
-    if not hits_list:
+    if not n_hits:
         return clusters
 
-    n_clusters = max(hit.seed for hit in hits_list) + 1
+    seeds = np.array(seeds)
+    n_clusters = seeds.max() + 1
     for i in range(n_clusters):
-        cluster_hits = []
-        for hit in hits_list:
-            if hit.seed == i:
-                cluster_hits.append(hit)
-        clusters.append(TrCluster(cluster_hits))
+        clusters.append(TrCluster(hits.take(np.flatnonzero(seeds == i))))
 
     clusters.sort(key=lambda x: x.energy, reverse=True)
 
@@ -259,12 +490,238 @@ def make_tr_clusters(hits_list):
 
 
 def make_clusters_lists(hits_tr1, hits_tr2, hits_cal):
+    """Return clusters of the event. Hits are HitBatch of each detector"""
     clusters_tr1 = make_tr_clusters(hits_tr1)
     clusters_tr2 = make_tr_clusters(hits_tr2)
     clusters_cal = make_cal_clusters(hits_cal)
     return clusters_tr1, clusters_tr2, clusters_cal
 
 
+class ClusterBatch:
+    '''
+    Clusters of many events as flat arrays, sorted by energy within each event.
+    Clusters of event i are [offsets[i]:offsets[i + 1]].
+    hit_cluster is the index of the cluster of each hit of the input HitBatch, -1 if none.
+    n_towers and layer are None for trackers.
+    '''
+    FIELDS = ('energy', 'sector', 'pad', 'layer', 'x', 'y', 'n_pads', 'n_towers')
+
+    def __init__(self, offsets, hit_cluster, energy, sector, pad, x, y, n_pads, layer=None, n_towers=None):
+        self.offsets = offsets
+        self.hit_cluster = hit_cluster
+        self.energy = energy
+        self.sector = sector
+        self.pad = pad
+        self.layer = layer
+        self.x = x
+        self.y = y
+        self.n_pads = n_pads
+        self.n_towers = n_towers
+
+    @property
+    def n_events(self):
+        return len(self.offsets) - 1
+
+    def __len__(self):
+        return len(self.energy)
+
+    def fields(self):
+        """Return dict of all not empty per-cluster arrays"""
+        return {name: getattr(self, name) for name in self.FIELDS if getattr(self, name) is not None}
+
+    def reorder(self, order):
+        """Return ClusterBatch with clusters in the order. Clusters must stay within their events"""
+        rank = np.empty(len(order), dtype=np.int64)
+        rank[order] = np.arange(len(order))
+        hit_cluster = relabel(self.hit_cluster, rank)
+        arrays = {name: array[order] for name, array in self.fields().items()}
+        return ClusterBatch(self.offsets, hit_cluster, **arrays)
+
+
+def sort_by_cal_distance(clusters_tr, clusters_cal):
+    """Return tracker ClusterBatch sorted within each event by distance in y
+    to the most energetic calorimeter cluster. Events without calorimeter clusters keep the energy order
+    """
+    n_events = clusters_tr.n_events
+    event = np.repeat(np.arange(n_events), np.diff(clusters_tr.offsets))
+    has_cal = np.diff(clusters_cal.offsets) > 0
+    leading_y = np.zeros(n_events)
+    leading_y[has_cal] = clusters_cal.y[clusters_cal.offsets[:-1][has_cal]]
+    distance = np.where(has_cal[event], np.abs(clusters_tr.y - leading_y[event]), 0.)
+    return clusters_tr.reorder(np.lexsort((distance, event)))
+
+
+def relabel(hit_cluster, new_index):
+    """Return hit_cluster with cluster i renamed to new_index[i], -1 stays -1.
+    Only assigned hits are indexed: new_index is empty if there are no clusters
+    """
+    hit_cluster = hit_cluster.copy()
+    assigned = hit_cluster != -1
+    hit_cluster[assigned] = new_index[hit_cluster[assigned]]
+    return hit_cluster
+
+
+def batch_moments(hits, hit_cluster, n_clusters, log_weight, hit_order=None):
+    """Return energy, n_pads and weighted mean sector, pad, layer, x, y of all clusters.
+    Same weights as ClusterMoments, sums are done with bincount over hits of all events
+    in the hit_order, so energies are added in the same order as by ClusterMoments
+    """
+    if hit_order is None:
+        hit_order = np.arange(len(hits))
+    hit_order = hit_order[hit_cluster[hit_order] != -1]
+    label = hit_cluster[hit_order]
+    hit_energy = hits.energy[hit_order]
+    energy = np.bincount(label, weights=hit_energy, minlength=n_clusters)
+    n_pads = np.bincount(label, minlength=n_clusters)
+    if log_weight is None:
+        weights = hit_energy
+    else:
+        with np.errstate(divide='ignore', invalid='ignore'):
+            weights = log_weight + np.log(hit_energy / energy[label])
+        weights = np.where(weights > 0, weights, 0.)
+    sum_of_weights = np.bincount(label, weights=weights, minlength=n_clusters)
+
+    means = []
+    for name in ('sector', 'pad', 'layer', 'x', 'y'):
+        weighted_sum = np.bincount(label, weights=getattr(hits, name)[hit_order] * weights, minlength=n_clusters)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            means.append(np.where(sum_of_weights != 0, weighted_sum / sum_of_weights, -999.))
+    return energy, n_pads, means
+
+
+def sort_clusters(energy, cluster_event, n_events):
+    """Return order of the clusters by energy within each event and the event offsets"""
+    order = np.lexsort((-energy, cluster_event))
+    offsets = np.zeros(n_events + 1, dtype=np.int64)
+    np.cumsum(np.bincount(cluster_event, minlength=n_events), out=offsets[1:])
+    return order, offsets
+
+
+def label_clusters(seeds, item_event, n_events):
+    """Return global cluster index of each tower or hit out of seeds numbered within the event"""
+    n_clusters = np.zeros(n_events, dtype=np.int64)
+    np.maximum.at(n_clusters, item_event, seeds + 1)
+    cluster_offsets = np.zeros(n_events + 1, dtype=np.int64)
+    np.cumsum(n_clusters, out=cluster_offsets[1:])
+    labels = np.where(seeds != -1, cluster_offsets[item_event] + seeds, -1)
+    cluster_event = np.repeat(np.arange(n_events), n_clusters)
+    return labels, cluster_event
+
+
+def make_cal_clusters_batch(hits, log_weight=3.4):
+    """Return ClusterBatch of calorimeter HitBatch with many events.
+    Same clustering as make_cal_clusters. Towers, seeds and cluster moments are done for all events at once,
+    growing of clusters and merging are done only in events which need them
+    """
+    n_events = hits.n_events
+    towers = make_towers(hits)
+    seeds = find_seeds(towers.sector, towers.pad, towers.energy, towers.offsets, towers.n_pads != 1)
+    tower_event = np.repeat(np.arange(n_events), np.diff(towers.offsets))
+
+    # Events with both seeds and not assigned towers
+    n_seeds = np.bincount(tower_event[seeds != -1], minlength=n_events)
+    n_not_seeds = np.bincount(tower_event[seeds == -1], minlength=n_events)
+    for event in np.flatnonzero((n_seeds > 0) & (n_not_seeds > 0)):
+        begin, end = towers.offsets[event], towers.offsets[event + 1]
+        seeds[begin:end] = grow_clusters(towers.sector[begin:end], towers.pad[begin:end],
+                                         towers.energy[begin:end], seeds[begin:end])
+
+    tower_cluster, cluster_event = label_clusters(seeds, tower_event, n_events)
+    n_clusters = len(cluster_event)
+    hit_cluster = np.full(len(hits), -1, dtype=np.int64)
+    hit_cluster[towers.hit_idx] = np.repeat(tower_cluster, towers.n_pads)
+
+    # Hits of the cluster are taken tower by tower, as in make_cal_clusters
+    energy, n_pads, means = batch_moments(hits, hit_cluster, n_clusters, log_weight, towers.hit_idx)
+    n_towers = np.bincount(tower_cluster[tower_cluster != -1], minlength=n_clusters)
+    fields = [energy, n_pads, n_towers] + means
+    cluster_offsets = np.zeros(n_events + 1, dtype=np.int64)
+    np.cumsum(np.bincount(cluster_event, minlength=n_events), out=cluster_offsets[1:])
+
+    # Merging is done with CalCluster objects in events with more than one cluster
+    keep = np.ones(n_clusters, dtype=bool)
+    for event in np.flatnonzero(np.diff(cluster_offsets) > 1):
+        begin, end = cluster_offsets[event], cluster_offsets[event + 1]
+        hits_begin = hits.offsets[event]
+        event_hits = hits.event(event)
+        event_hit_idx = towers.hit_idx[towers.hit_offsets[towers.offsets[event]]:
+                                       towers.hit_offsets[towers.offsets[event + 1]]]
+        event_hit_cluster = hit_cluster[event_hit_idx]
+        clusters = []
+        for cluster in range(begin, end):
+            hit_idx = event_hit_idx[event_hit_cluster == cluster] - hits_begin
+            clusters.append(CalCluster(event_hits.take(hit_idx), int(n_towers[cluster]), log_weight, hit_idx))
+        clusters.sort(key=lambda x: x.energy, reverse=True)
+        merge_clusters(clusters)
+        clusters.sort(key=lambda x: x.energy, reverse=True)
+
+        for k, cluster in enumerate(clusters):
+            values = (cluster.energy, cluster.n_pads, cluster.n_towers,
+                      cluster.sector, cluster.pad, cluster.layer, cluster.x, cluster.y)
+            for field, value in zip(fields, values):
+                field[begin + k] = value
+            hit_cluster[hits_begin + cluster.hit_idx] = begin + k
+        keep[begin + len(clusters):end] = False
+
+    new_index = np.cumsum(keep) - 1
+    hit_cluster = relabel(hit_cluster, new_index)
+    fields = [field[keep] for field in fields]
+    cluster_event = cluster_event[keep]
+
+    order, offsets = sort_clusters(fields[0], cluster_event, n_events)
+    rank = np.empty(len(order), dtype=np.int64)
+    rank[order] = np.arange(len(order))
+    hit_cluster = relabel(hit_cluster, rank)
+    energy, n_pads, n_towers, sector, pad, layer, x, y = [field[order] for field in fields]
+    return ClusterBatch(offsets, hit_cluster, energy, sector, pad, x, y, n_pads, layer, n_towers)
+
+
+def make_tr_clusters_batch(hits):
+    """Return ClusterBatch of tracker plane HitBatch with many events. Same clustering as make_tr_clusters"""
+    n_events = hits.n_events
+    seeds = find_seeds(hits.sector, hits.pad, hits.energy, hits.offsets)
+    hit_event = hits.event_index()
+
+    # Events with not seed hits
+    for event in np.unique(hit_event[seeds == -1]):
+        begin, end = hits.offsets[event], hits.offsets[event + 1]
+        seeds[begin:end] = assign_tr_hits(hits.sector[begin:end], hits.pad[begin:end],
+                                          hits.energy[begin:end], seeds[begin:end])
+
+    hit_cluster, cluster_event = label_clusters(seeds, hit_event, n_events)
+    n_clusters = len(cluster_event)
+    energy, n_pads, means = batch_moments(hits, hit_cluster, n_clusters, None)
+    sector, pad, _, x, y = means
+
+    order, offsets = sort_clusters(energy, cluster_event, n_events)
+    rank = np.empty(n_clusters, dtype=np.int64)
+    rank[order] = np.arange(n_clusters)
+    hit_cluster = relabel(hit_cluster, rank)
+    return ClusterBatch(offsets, hit_cluster, energy[order], sector[order], pad[order],
+                        x[order], y[order], n_pads[order])
+
+
+def make_clusters_batch(hits_tr1, hits_tr2, hits_cal, log_weight=3.4):
+    """Return ClusterBatch of each detector. Hits are HitBatch of many events"""
+    return (make_tr_clusters_batch(hits_tr1), make_tr_clusters_batch(hits_tr2),
+            make_cal_clusters_batch(hits_cal, log_weight))
+
+
+def compare_cal_clusters_batch(hits, log_weight=3.4):
+    """Return events of HitBatch where make_cal_clusters_batch differs from make_cal_clusters"""
+    batch = make_cal_clusters_batch(hits, log_weight)
+    differ = []
+    for event in range(hits.n_events):
+        clusters = make_cal_clusters(hits.event(event), log_weight)
+        begin, end = batch.offsets[event], batch.offsets[event + 1]
+        if len(clusters) != end - begin or not all(
+                np.isclose(cluster.energy, batch.energy[k]) and np.isclose(cluster.x, batch.x[k])
+                and np.isclose(cluster.y, batch.y[k]) and cluster.n_pads == batch.n_pads[k]
+                for k, cluster in zip(range(begin, end), clusters)):
+            differ.append(event)
+    return differ
+
+
 ###########################################################
 # These functions might be useful once to see how the event looks like.
 # You can ignore or remove them.
@@ -314,3 +771,14 @@ def plot_sensor_clusters(towers_list):
 
     c.Print("./clustering{}.png".format(pic_number))
     pic_number += 1
+
+
+if __name__ == "__main__":
+    # Regression check of the batch clustering against the per-event one:
+    # events without seeds (single pad towers only), empty events and events with clusters
+    no_seeds = HitBatch([1, 2], [30, 40], [2, 3], [1.0, 2.0], offsets=[0, 1, 2])
+    assert compare_cal_clusters_batch(no_seeds) == []
+    mixed = HitBatch([1, 1, 1, 2, 0, 3], [30, 30, 31, 40, 25, 50], [2, 3, 2, 3, 4, 5],
+                     [5.0, 4.0, 1.0, 2.0, 3.0, 1.0], offsets=[0, 0, 4, 5, 6])
+    assert compare_cal_clusters_batch(mixed) == []
+    print("Batch clustering is the same as per event")
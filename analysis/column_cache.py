@@ -0,0 +1,131 @@
+'''
+Columnar cache of the output trees as .npy files.
+Next to "output.root" the directory "output_columns/" gets one .npy file
+per branch of the schema (see output_tree.py) with values of all events
+one after another, "<counter>_offsets.npy" for each counter
+(values of event i are array[offsets[i]:offsets[i + 1]])
+and "schema.json" with the tree name, number of events and the layout.
+Files are opened with np.load(mmap_mode='r'): nothing is read until used
+and only the pages of the used columns are read, no ROOT needed.
+    cache = ColumnCache("./extracted_data_RENAME_columns")
+    cluster_energy = cache.event('cal_cluster_energy', 0)
+    # Leading cluster energy of the events with clusters
+    offsets = cache.offsets('cal_n_clusters')
+    has_clusters = np.diff(offsets) > 0
+    leading_energy = cache['cal_cluster_energy'][offsets[:-1][has_clusters]]
+'''
+
+import os
+import json
+import shutil
+import numpy as np
+from output_tree import LEAF_DTYPES
+
+
+def cache_path(root_path):
+    """Return directory of the cache next to the root file"""
+    base = root_path[:-len('.root')] if root_path.endswith('.root') else root_path
+    return base + '_columns'
+
+
+class CacheWriter:
+    '''
+    Writes chunks of events into the cache directory.
+    fill() takes the same columns and offsets as ChunkWriter.fill().
+    Values are appended to raw files, close() adds .npy headers and offsets.
+    '''
+    def __init__(self, directory, schema, tree_name):
+        self.directory = directory
+        self.schema = schema
+        self.tree_name = tree_name
+        self.counters = {counter for _, _, counter in schema if counter is not None}
+        self.n_events = 0
+        self.sizes = {name: 0 for name, _, _ in schema}
+
+        os.makedirs(directory, exist_ok=True)
+        self.files = {name: open(self.raw_path(name), 'wb') for name, _, _ in schema}
+
+    def path(self, name):
+        return os.path.join(self.directory, name + '.npy')
+
+    def raw_path(self, name):
+        return self.path(name) + '.part'
+
+    def fill(self, n_events, columns, offsets):
+        for name, leaf_type, counter in self.schema:
+            if name in self.counters:
+                values = np.diff(offsets[name])
+            else:
+                values = columns[name]
+            values = np.ascontiguousarray(values, dtype=LEAF_DTYPES[leaf_type])
+            self.files[name].write(values.tobytes())
+            self.sizes[name] += len(values)
+        self.n_events += n_events
+
+    def append(self, cache):
+        """Append all events of ColumnCache with the same schema, files are copied as they are"""
+        for name, _, _ in self.schema:
+            with open(cache.path(name), 'rb') as f:
+                np.lib.format.read_magic(f)
+                shape, _, _ = np.lib.format.read_array_header_1_0(f)
+                shutil.copyfileobj(f, self.files[name])
+            self.sizes[name] += shape[0]
+        self.n_events += len(cache)
+
+    def close(self):
+        for name, leaf_type, _ in self.schema:
+            self.files[name].close()
+            header = {'descr': np.lib.format.dtype_to_descr(np.dtype(LEAF_DTYPES[leaf_type])),
+                      'fortran_order': False, 'shape': (self.sizes[name],)}
+            with open(self.path(name), 'wb') as f, open(self.raw_path(name), 'rb') as raw:
+                np.lib.format.write_array_header_1_0(f, header)
+                shutil.copyfileobj(raw, f)
+            os.remove(self.raw_path(name))
+
+        for counter in self.counters:
+            counts = np.load(self.path(counter), mmap_mode='r')
+            offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+            np.cumsum(counts, out=offsets[1:])
+            np.save(os.path.join(self.directory, counter + '_offsets.npy'), offsets)
+
+        with open(os.path.join(self.directory, 'schema.json'), 'w') as f:
+            json.dump({'tree': self.tree_name, 'n_events': self.n_events,
+                       'schema': [list(branch) for branch in self.schema]}, f, indent=1)
+
+
+class ColumnCache:
+    """Read-only access to the cache directory. Columns are memory mapped on first use"""
+    def __init__(self, directory):
+        self.directory = directory
+        with open(os.path.join(directory, 'schema.json')) as f:
+            info = json.load(f)
+        self.tree_name = info['tree']
+        self.n_events = info['n_events']
+        self.schema = [tuple(branch) for branch in info['schema']]
+        self.counter = {name: counter for name, _, counter in self.schema}
+        self.columns = {}
+
+    def __len__(self):
+        return self.n_events
+
+    def branches(self):
+        return [name for name, _, _ in self.schema]
+
+    def path(self, branch):
+        return os.path.join(self.directory, branch + '.npy')
+
+    def __getitem__(self, branch):
+        if branch not in self.columns:
+            self.columns[branch] = np.load(self.path(branch), mmap_mode='r')
+        return self.columns[branch]
+
+    def offsets(self, counter):
+        return self[counter + '_offsets']
+
+    def event(self, branch, i):
+        """Return values of the branch in event i"""
+        counter = self.counter[branch]
+        if counter is None:
+            return self[branch][i]
+        offsets = self.offsets(counter)
+        return self[branch][offsets[i]:offsets[i + 1]]
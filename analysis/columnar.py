@@ -0,0 +1,107 @@
+'''
+Bulk reading of ROOT trees as flat NumPy arrays.
+Instead of looping over events through PyROOT proxies, a chunk of entries
+is drawn at once with TTree::Draw and each branch is returned as one flat
+array. Per-event boundaries are kept in an offsets array:
+values of event i are array[offsets[i]:offsets[i + 1]]
+'''
+
+import numpy as np
+
+
+def draw_values(tree, i, n_rows):
+    """Return copy of the i-th variable of the last TTree::Draw as numpy array"""
+    if n_rows == 0:
+        return np.zeros(0)
+    buffer = tree.GetVal(i)
+    buffer.reshape((n_rows,))
+    # Copy, the buffer is reused by the next Draw
+    return np.array(buffer, dtype=np.float64)
+
+
+class Chunk:
+    '''
+    Entries [first, first + n_entries) of the tree.
+    arrays is a dict branch name -> flat float64 array.
+    Scalar branches have one value per entry, arrays of the group g
+    are split into entries by offsets[g].
+    '''
+    def __init__(self, first, n_entries, offsets, arrays):
+        self.first = first
+        self.n_entries = n_entries
+        self.offsets = offsets
+        self.arrays = arrays
+
+    def __getitem__(self, branch):
+        return self.arrays[branch]
+
+
+class ChunkReader:
+    '''
+    Reads selected branches of the tree in chunks of entries.
+    Array branches are given in groups: group name -> list of branches
+    with the same length in every entry (e.g. "cal_" -> cal_sector, cal_pad, ...).
+    Only the given branches are activated, others are not read at all.
+    Entries [first, first + n_entries) are read, n_entries=None reads to the end of the tree.
+    '''
+    def __init__(self, tree, groups=None, scalars=(), chunk_size=10000, n_entries=None, first=0):
+        self.tree = tree
+        self.groups = dict(groups or {})
+        self.scalars = list(scalars)
+        self.chunk_size = chunk_size
+        self.first = first
+        n_left = max(tree.GetEntries() - first, 0)
+        self.n_entries = n_left if n_entries is None else min(n_entries, n_left)
+
+        tree.SetBranchStatus("*", 0)
+        for branch in self.branches():
+            tree.SetBranchStatus(branch, 1)
+
+    def branches(self):
+        return [branch for group in self.groups.values() for branch in group] + self.scalars
+
+    def __len__(self):
+        return self.n_entries
+
+    def __iter__(self):
+        end = self.first + self.n_entries
+        for first in range(self.first, end, self.chunk_size):
+            yield self.read(first, min(self.chunk_size, end - first))
+
+    def draw(self, branches, n_chunk, first, n_rows):
+        """Return dict branch -> values of all branches drawn in one go"""
+        if n_rows > 0:
+            self.tree.SetEstimate(n_rows + 1)
+            self.tree.Draw(":".join(branches), "", "goff", n_chunk, first)
+        return {branch: draw_values(self.tree, i, n_rows) for i, branch in enumerate(branches)}
+
+    def read(self, first, n_chunk):
+        """Return Chunk of n_chunk entries starting from first"""
+        tree = self.tree
+        offsets = {}
+        arrays = {}
+        for name, branches in self.groups.items():
+            # 1st pass: number of elements in each event
+            tree.SetEstimate(n_chunk + 1)
+            tree.Draw("Length$({})".format(branches[0]), "", "goff", n_chunk, first)
+            counts = draw_values(tree, 0, n_chunk).astype(np.int64)
+            offsets[name] = np.zeros(n_chunk + 1, dtype=np.int64)
+            np.cumsum(counts, out=offsets[name][1:])
+
+            # 2nd pass: values of all branches of the group
+            arrays.update(self.draw(branches, n_chunk, first, int(offsets[name][-1])))
+
+        if self.scalars:
+            arrays.update(self.draw(self.scalars, n_chunk, first, n_chunk))
+
+        return Chunk(first, n_chunk, offsets, arrays)
+
+
+def read_chunks(tree, branches, chunk_size=10000):
+    """
+    Yield (first_entry, offsets, arrays) for consecutive chunks of entries.
+    All branches must be arrays of the same length within an event.
+    arrays is a dict branch name -> flat float64 array of the chunk.
+    """
+    for chunk in ChunkReader(tree, {'': branches}, chunk_size=chunk_size):
+        yield chunk.first, chunk.offsets[''], chunk.arrays
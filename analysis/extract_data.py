@@ -6,281 +6,185 @@ information
 
 
 from ROOT import TFile, TTree
-import array
-import time
-import numpy as np
-from clustering import make_clusters_lists
+from clustering import make_clusters_batch, sort_by_cal_distance
+from hit import HitBatch
+from columnar import ChunkReader
+from output_tree import ChunkWriter, DATA_SCHEMA, hits_columns, clusters_columns
+from column_cache import CacheWriter, cache_path
+from geometry import load_alignment
+from channel_status import load_channel_status, DEFAULT_RUN_PERIOD
+from parallel import run_parallel
+from instrumentation import PhaseTimer, count_chunk, profiled, profile_path
+from memory_monitor import MemoryMonitor, memory_path
 
 import argparse
 
 
-# This is Hit object
-class Hit:
-    def __init__(self, sector, pad, layer, energy):
-        self.sector = sector
-        self.pad = pad
-        self.layer = layer
-        self.energy = energy
+# Branches of the signals_selection.py output tree
+HIT_BRANCHES = ['sector', 'pad', 'layer', 'energy']
 
-        rho = 80.9 + 1.8 * pad
-        phi = np.pi / 24. * (13.5 - sector)
-        self.x = rho * np.cos(phi)
-        self.y = rho * np.sin(phi)
 
-        if layer == 0 or layer == 1:
-            self.seed = -1
-
-
-def make_hits_lists(event):
+def make_hits_lists(chunk, channel_status, nn_cut=None):
     """
-    # Input: single event
-    # Output: 3 List of Hit objects for tracker1 tracker2, calorimeter
-    # in this event
+    # Input: Chunk of events with HIT_BRANCHES (see columnar.py)
+    # channel_status: ChannelStatus with geometrical cuts and bad pads
+    # nn_cut: optional NN cut on hits. Needs the nn_output branch
+    # written by signals_selection.py --keep-nn
+    # Output: 3 HitBatch objects for tracker1 tracker2, calorimeter
+    # with all events of the chunk
     # NOTE: in TB20 there is a different tracker.
     # And the whole algorithm will be different anyway!
     """
+    hits = HitBatch(chunk['sector'], chunk['pad'], chunk['layer'], chunk['energy'], chunk.offsets['hits'])
 
-    # Create empty lists
-    hits_calorimeter = []
-    hits_tracker1 = []
-    hits_tracker2 = []
-
-    # Loop through hits in the event
-    for sector, pad, layer, energy in zip(event.sector, event.pad,
-                                          event.layer, event.energy):
+    # Geometrical cuts and bad pads of the run period
+    good = ~channel_status.is_bad(hits.sector, hits.pad, hits.layer)
 
-        # Geometrical cuts
-        if (pad < 20 or sector == 0 or sector == 3 or layer == 7):
-            continue
+    # NN cut as in signals_selection.py
+    if nn_cut is not None:
+        good &= ~(chunk['nn_output'] < nn_cut)
 
-        if layer == 0:
-            hits_tracker1.append(Hit(sector, pad, layer, energy))
-        elif layer == 1:
-            hits_tracker2.append(Hit(sector, pad, layer, energy))
-        else:
-            hits_calorimeter.append(Hit(sector, pad, layer, energy))
+    hits_tracker1 = hits.select(good & (hits.layer == 0))
+    hits_tracker2 = hits.select(good & (hits.layer == 1))
+    hits_calorimeter = hits.select(good & (hits.layer > 1))
 
     return hits_tracker1, hits_tracker2, hits_calorimeter
 
 
-def align_data(hits_tr1, hits_tr2, hits_cal):
+def hit_branches(nn_cut=None):
+    """Return branches to read. nn_output is read only for the NN cut"""
+    return HIT_BRANCHES + (['nn_output'] if nn_cut is not None else [])
+
+
+def align_data(hits_tr1, hits_tr2, hits_cal, alignment):
     '''
-    Shift hit's y coordinates to take into account misalignment
-    This is very poorely done here. As it takes calorimeter as a whole.
-    When is better allign each individual plane.
-    Don't pay much attention to this right now
+    Move hits to take into account misalignment of each plane.
+    Transforms of the planes are in alignment_data.txt
     '''
-    tr1_shift = -0.14156476251841354
-    tr2_shift = 0.9273328597379873
-    cal_shift = -0.785768097219659
+    for hits in (hits_tr1, hits_tr2, hits_cal):
+        alignment.apply(hits)
 
-    for hit in hits_tr1:
-        hit.y -= tr1_shift
-    for hit in hits_tr2:
-        hit.y -= tr2_shift
-    for hit in hits_cal:
-        hit.y -= cal_shift
 
+def process_chunk(chunk, nn_cut, channel_status, alignment, timer):
+    """
+    Return columns and offsets of DATA_SCHEMA with hits and clusters of all events of the chunk.
+    Time of hits building, alignment and clustering goes to the phases of timer (PhaseTimer)
+    """
+    # Create hits of all events in the chunk and align them
+    with timer.phase('hits') as phase:
+        hits_tr1, hits_tr2, hits_cal = make_hits_lists(chunk, channel_status, nn_cut)
+        n_hits = len(hits_tr1) + len(hits_tr2) + len(hits_cal)
+        phase.count(chunk.n_entries, n_hits)
 
-def main(args):
-    # Timer
-    start_time = time.time()
+    with timer.phase('align') as phase:
+        align_data(hits_tr1, hits_tr2, hits_cal, alignment)
+        phase.count(chunk.n_entries, n_hits)
+
+    with timer.phase('cluster') as phase:
+        # Create clusters for all events. Clusterin algorithm is in the "clustering.py" file
+        clusters_tr1, clusters_tr2, clusters_cal = make_clusters_batch(hits_tr1, hits_tr2, hits_cal)
 
+        # Resort clusters in trackers by distance to the most energetic cluster in calorimeter
+        clusters_tr1 = sort_by_cal_distance(clusters_tr1, clusters_cal)
+        clusters_tr2 = sort_by_cal_distance(clusters_tr2, clusters_cal)
+        phase.count(chunk.n_entries, n_hits)
+
+    # Columns of the output tree
+    columns, offsets = {}, {}
+    for prefix, hits, clusters in (('tr1_', hits_tr1, clusters_tr1),
+                                   ('tr2_', hits_tr2, clusters_tr2),
+                                   ('cal_', hits_cal, clusters_cal)):
+        for part_columns, part_offsets in (hits_columns(prefix, hits), clusters_columns(prefix, clusters)):
+            columns.update(part_columns)
+            offsets.update(part_offsets)
+    return columns, offsets
+
+
+def extract(args, first, n_entries, output_path):
+    """Process entries [first, first + n_entries) of the input into the tree of output_path"""
     # Upload data for analysis
     input_file = TFile.Open(args.path_to_file, "READ")
     input_tree = input_file.data
-    print("Total n events in loaded files: ", input_tree.GetEntries())
+    reader = ChunkReader(input_tree, {'hits': hit_branches(args.nn)}, chunk_size=args.chunk_size,
+                         n_entries=n_entries, first=first)
+
+    # Transforms of each plane to correct misalignment
+    alignment = load_alignment(args.alignment)
+
+    # Geometrical cuts and bad pads
+    channel_status = load_channel_status(args.run_period)
 
     # Create output root file.
     # Create output root file before the tree!!! It prevents memory leakage
-    output_file = TFile('./extracted_data_RENAME.root', "RECREATE")
+    output_file = TFile(output_path, "RECREATE")
     output_tree = TTree('data', 'Extracted Data')
 
-    # Create variables associated with the output tree
-    tr1_n_hits = array.array('i', [0])
-    tr1_hit_pad = array.array('i', [0] * 128)
-    tr1_hit_sector = array.array('i', [0] * 128)
-    tr1_hit_layer = array.array('i', [0] * 128)
-    tr1_hit_x = array.array('f', [0.0] * 128)
-    tr1_hit_y = array.array('f', [0.0] * 128)
-    tr1_hit_energy = array.array('f', [0.0] * 128)
-    tr1_n_clusters = array.array('i', [0])
-    tr1_cluster_n_pads = array.array('i', [0] * 128)
-    tr1_cluster_pad = array.array('f', [0.0] * 128)
-    tr1_cluster_sector = array.array('f', [0.0] * 128)
-    tr1_cluster_x = array.array('f', [0.0] * 128)
-    tr1_cluster_y = array.array('f', [0.0] * 128)
-    tr1_cluster_energy = array.array('f', [0.0] * 128)
-
-    tr2_n_hits = array.array('i', [0])
-    tr2_hit_pad = array.array('i', [0] * 128)
-    tr2_hit_sector = array.array('i', [0] * 128)
-    tr2_hit_layer = array.array('i', [0] * 128)
-    tr2_hit_x = array.array('f', [0.0] * 128)
-    tr2_hit_y = array.array('f', [0.0] * 128)
-    tr2_hit_energy = array.array('f', [0.0] * 128)
-    tr2_n_clusters = array.array('i', [0])
-    tr2_cluster_n_pads = array.array('i', [0] * 128)
-    tr2_cluster_pad = array.array('f', [0.0] * 128)
-    tr2_cluster_sector = array.array('f', [0.0] * 128)
-    tr2_cluster_x = array.array('f', [0.0] * 128)
-    tr2_cluster_y = array.array('f', [0.0] * 128)
-    tr2_cluster_energy = array.array('f', [0.0] * 128)
-
-    cal_n_hits = array.array('i', [0])
-    cal_hit_pad = array.array('i', [0] * 128 * 5)
-    cal_hit_sector = array.array('i', [0] * 128 * 5)
-    cal_hit_layer = array.array('i', [0] * 128 * 5)
-    cal_hit_x = array.array('f', [0.0] * 128 * 5)
-    cal_hit_y = array.array('f', [0.0] * 128 * 5)
-    cal_hit_energy = array.array('f', [0.0] * 128 * 5)
-    cal_n_clusters = array.array('i', [0])
-    cal_cluster_n_pads = array.array('i', [0] * 128 * 5)
-    cal_cluster_n_towers = array.array('i', [0] * 128 * 5)
-    cal_cluster_pad = array.array('f', [0.0] * 128 * 5)
-    cal_cluster_sector = array.array('f', [0.0] * 128 * 5)
-    cal_cluster_layer = array.array('f', [0.0] * 128 * 5)
-    cal_cluster_x = array.array('f', [0.0] * 128 * 5)
-    cal_cluster_y = array.array('f', [0.0] * 128 * 5)
-    cal_cluster_energy = array.array('f', [0.0] * 128 * 5)
-
-    # Create branches in the output tree for these variables
-    output_tree.Branch('tr1_n_hits', tr1_n_hits, 'tr1_n_hits/I')
-    output_tree.Branch('tr1_hit_pad', tr1_hit_pad, 'tr1_hit_pad[tr1_n_hits]/I')
-    output_tree.Branch('tr1_hit_sector', tr1_hit_sector, 'tr1_hit_sector[tr1_n_hits]/I')
-    output_tree.Branch('tr1_hit_layer', tr1_hit_layer, 'tr1_hit_layer[tr1_n_hits]/I')
-    output_tree.Branch('tr1_hit_x', tr1_hit_x, 'tr1_hit_x[tr1_n_hits]/F')
-    output_tree.Branch('tr1_hit_y', tr1_hit_y, 'tr1_hit_y[tr1_n_hits]/F')
-    output_tree.Branch('tr1_hit_energy', tr1_hit_energy, 'tr1_hit_energy[tr1_n_hits]/F')
-    output_tree.Branch('tr1_n_clusters', tr1_n_clusters, 'tr1_n_clusters/I')
-    output_tree.Branch('tr1_cluster_n_pads', tr1_cluster_n_pads, 'tr1_cluster_n_pads[tr1_n_clusters]/I')
-    output_tree.Branch('tr1_cluster_pad', tr1_cluster_pad, 'tr1_cluster_pad[tr1_n_clusters]/F')
-    output_tree.Branch('tr1_cluster_sector', tr1_cluster_sector, 'tr1_cluster_sector[tr1_n_clusters]/F')
-    output_tree.Branch('tr1_cluster_x', tr1_cluster_x, 'tr1_cluster_x[tr1_n_clusters]/F')
-    output_tree.Branch('tr1_cluster_y', tr1_cluster_y, 'tr1_cluster_y[tr1_n_clusters]/F')
-    output_tree.Branch('tr1_cluster_energy', tr1_cluster_energy, 'tr1_cluster_energy[tr1_n_clusters]/F')
-
-    output_tree.Branch('tr2_n_hits', tr2_n_hits, 'tr2_n_hits/I')
-    output_tree.Branch('tr2_hit_pad', tr2_hit_pad, 'tr2_hit_pad[tr2_n_hits]/I')
-    output_tree.Branch('tr2_hit_sector', tr2_hit_sector, 'tr2_hit_sector[tr2_n_hits]/I')
-    output_tree.Branch('tr2_hit_layer', tr2_hit_layer, 'tr2_hit_layer[tr2_n_hits]/I')
-    output_tree.Branch('tr2_hit_x', tr2_hit_x, 'tr2_hit_x[tr2_n_hits]/F')
-    output_tree.Branch('tr2_hit_y', tr2_hit_y, 'tr2_hit_y[tr2_n_hits]/F')
-    output_tree.Branch('tr2_hit_energy', tr2_hit_energy, 'tr2_hit_energy[tr2_n_hits]/F')
-    output_tree.Branch('tr2_n_clusters', tr2_n_clusters, 'tr2_n_clusters/I')
-    output_tree.Branch('tr2_cluster_n_pads', tr2_cluster_n_pads, 'tr2_cluster_n_pads[tr2_n_clusters]/I')
-    output_tree.Branch('tr2_cluster_pad', tr2_cluster_pad, 'tr2_cluster_pad[tr2_n_clusters]/F')
-    output_tree.Branch('tr2_cluster_sector', tr2_cluster_sector, 'tr2_cluster_sector[tr2_n_clusters]/F')
-    output_tree.Branch('tr2_cluster_x', tr2_cluster_x, 'tr2_cluster_x[tr2_n_clusters]/F')
-    output_tree.Branch('tr2_cluster_y', tr2_cluster_y, 'tr2_cluster_y[tr2_n_clusters]/F')
-    output_tree.Branch('tr2_cluster_energy', tr2_cluster_energy, 'tr2_cluster_energy[tr2_n_clusters]/F')
-
-    output_tree.Branch('cal_n_hits', cal_n_hits, 'cal_n_hits/I')
-    output_tree.Branch('cal_hit_pad', cal_hit_pad, 'cal_hit_pad[cal_n_hits]/I')
-    output_tree.Branch('cal_hit_sector', cal_hit_sector, 'cal_hit_sector[cal_n_hits]/I')
-    output_tree.Branch('cal_hit_layer', cal_hit_layer, 'cal_hit_layer[cal_n_hits]/I')
-    output_tree.Branch('cal_hit_x', cal_hit_x, 'cal_hit_x[cal_n_hits]/F')
-    output_tree.Branch('cal_hit_y', cal_hit_y, 'cal_hit_y[cal_n_hits]/F')
-    output_tree.Branch('cal_hit_energy', cal_hit_energy, 'cal_hit_energy[cal_n_hits]/F')
-    output_tree.Branch('cal_n_clusters', cal_n_clusters, 'cal_n_clusters/I')
-    output_tree.Branch('cal_cluster_n_pads', cal_cluster_n_pads, 'cal_cluster_n_pads[cal_n_clusters]/I')
-    output_tree.Branch('cal_cluster_n_towers', cal_cluster_n_towers, 'cal_cluster_n_towers[cal_n_clusters]/I')
-    output_tree.Branch('cal_cluster_pad', cal_cluster_pad, 'cal_cluster_pad[cal_n_clusters]/F')
-    output_tree.Branch('cal_cluster_sector', cal_cluster_sector, 'cal_cluster_sector[cal_n_clusters]/F')
-    output_tree.Branch('cal_cluster_layer', cal_cluster_layer, 'cal_cluster_layer[cal_n_clusters]/F')
-    output_tree.Branch('cal_cluster_x', cal_cluster_x, 'cal_cluster_x[cal_n_clusters]/F')
-    output_tree.Branch('cal_cluster_y', cal_cluster_y, 'cal_cluster_y[cal_n_clusters]/F')
-    output_tree.Branch('cal_cluster_energy', cal_cluster_energy, 'cal_cluster_energy[cal_n_clusters]/F')
-
-    n_events = input_tree.GetEntries()
-    for idx, event in enumerate(input_tree):
-        # if idx == 10000:
-        #     break
-
-        if idx % (1000) == 0:
-            time_min = (time.time() - start_time) // 60
-            time_sec = (time.time() - start_time) % 60
-            print('Event: {} out of {};'.format(idx, n_events), end=' ')
-            print('{} min {} sec'.format(time_min, time_sec))
-
-        # Create hits lists for this event.
-        hits_tr1, hits_tr2, hits_cal = make_hits_lists(event)
-        # Align hits
-        align_data(hits_tr1, hits_tr2, hits_cal)
-
-        # Create clusters for this event. Clusterin algorithm is in the "clustering.py" file
-        clusters_tr1, clusters_tr2, clusters_cal = make_clusters_lists(hits_tr1, hits_tr2, hits_cal)
+    # Branches are written for whole chunks. Layout is in output_tree.py
+    writer = ChunkWriter(output_tree, DATA_SCHEMA)
+    cache = CacheWriter(cache_path(output_path), DATA_SCHEMA, 'data') if args.cache else None
 
-        # Resort clusters in trackers by distance to the most energetic cluster in calorimeter
-        if len(clusters_cal) != 0:
-            clusters_tr1.sort(key=lambda x: abs(x.y - clusters_cal[0].y))
-            clusters_tr2.sort(key=lambda x: abs(x.y - clusters_cal[0].y))
-
-        # Write results into variables associated with a tree and fill
-        tr1_n_hits[0] = len(hits_tr1)
-        for i, hit in enumerate(hits_tr1):
-            tr1_hit_pad[i] = hit.pad
-            tr1_hit_sector[i] = hit.sector
-            tr1_hit_layer[i] = hit.layer
-            tr1_hit_energy[i] = hit.energy
-            tr1_hit_x[i] = hit.x
-            tr1_hit_y[i] = hit.y
-        tr1_n_clusters[0] = len(clusters_tr1)
-        for i, cluster in enumerate(clusters_tr1):
-            tr1_cluster_n_pads[i] = cluster.n_pads
-            tr1_cluster_pad[i] = cluster.pad
-            tr1_cluster_sector[i] = cluster.sector
-            tr1_cluster_x[i] = cluster.x
-            tr1_cluster_y[i] = cluster.y
-            tr1_cluster_energy[i] = cluster.energy
-
-        tr2_n_hits[0] = len(hits_tr2)
-        for i, hit in enumerate(hits_tr2):
-            tr2_hit_pad[i] = hit.pad
-            tr2_hit_sector[i] = hit.sector
-            tr2_hit_layer[i] = hit.layer
-            tr2_hit_energy[i] = hit.energy
-            tr2_hit_x[i] = hit.x
-            tr2_hit_y[i] = hit.y
-        tr2_n_clusters[0] = len(clusters_tr2)
-        for i, cluster in enumerate(clusters_tr2):
-            tr2_cluster_n_pads[i] = cluster.n_pads
-            tr2_cluster_pad[i] = cluster.pad
-            tr2_cluster_sector[i] = cluster.sector
-            tr2_cluster_x[i] = cluster.x
-            tr2_cluster_y[i] = cluster.y
-            tr2_cluster_energy[i] = cluster.energy
-
-        cal_n_hits[0] = len(hits_cal)
-        for i, hit in enumerate(hits_cal):
-            cal_hit_pad[i] = hit.pad
-            cal_hit_sector[i] = hit.sector
-            cal_hit_layer[i] = hit.layer
-            cal_hit_x[i] = hit.x
-            cal_hit_y[i] = hit.y
-            cal_hit_energy[i] = hit.energy
-        cal_n_clusters[0] = len(clusters_cal)
-        for i, cluster in enumerate(clusters_cal):
-            cal_cluster_n_pads[i] = cluster.n_pads
-            cal_cluster_n_towers[i] = cluster.n_towers
-            cal_cluster_pad[i] = cluster.pad
-            cal_cluster_sector[i] = cluster.sector
-            cal_cluster_layer[i] = cluster.layer
-            cal_cluster_x[i] = cluster.x
-            cal_cluster_y[i] = cluster.y
-            cal_cluster_energy[i] = cluster.energy
-
-        output_tree.Fill()
-
-    output_tree.Write()
-    output_file.Close()
+    # Time of each phase of the loop
+    memory = MemoryMonitor(memory_path(output_path), args.memory) if args.memory else None
+    timer = PhaseTimer(len(reader), memory=memory)
+    with profiled(profile_path(output_path) if args.profile else None):
+        for chunk in timer.iterate('read', reader, count_chunk):
+            columns, offsets = process_chunk(chunk, args.nn, channel_status, alignment, timer)
+
+            with timer.phase('write') as phase:
+                writer.fill(chunk.n_entries, columns, offsets)
+                if cache is not None:
+                    cache.fill(chunk.n_entries, columns, offsets)
+                phase.count(chunk.n_entries)
+            timer.done(chunk.first + chunk.n_entries - reader.first)
 
+        with timer.phase('write'):
+            output_tree.Write()
+            output_file.Close()
+            if cache is not None:
+                cache.close()
+    timer.summary()
+
+
+def main(args):
+    input_file = TFile.Open(args.path_to_file, "READ")
+    n_events = input_file.data.GetEntries()
+    print("Total n events in loaded files: ", n_events)
+    input_file.Close()
+
+    output_path = args.output
+    if args.workers > 1:
+        # Entry ranges in separate processes, outputs are merged in the order of entries
+        run_parallel(extract, args, n_events, args.workers, output_path, 'data',
+                     cache=args.cache, profile=args.profile, memory=bool(args.memory))
+    else:
+        extract(args, 0, n_events, output_path)
+
+    if args.cache:
+        print("Column cache: ", cache_path(output_path))
     print("Hooray, extracted tree file is ready, take it :3")
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description=('Do selection and clustering of data'))
     parser.add_argument('path_to_file', type=str, help='Provide path to the root file')
+    parser.add_argument('--output', type=str, default='./extracted_data_RENAME.root',
+                        help='Output root file')
+    parser.add_argument('--alignment', type=str, default='./alignment_data.txt',
+                        help='File with alignment transforms of each layer')
+    parser.add_argument('--nn', type=float, default=None,
+                        help='NN Cutoff on hits of the tree made with signals_selection.py --keep-nn')
+    parser.add_argument('--run-period', type=str, default=DEFAULT_RUN_PERIOD,
+                        help='Run period of the channel status file')
+    parser.add_argument('--chunk-size', type=int, default=10000,
+                        help='Number of events read at once')
+    parser.add_argument('--cache', action='store_true',
+                        help='Also write .npy columns of the output tree into <output>_columns/')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of processes, each processes its own range of entries')
+    parser.add_argument('--profile', action='store_true',
+                        help='Profile the event loop with cProfile, stats are written into <output>.prof')
+    parser.add_argument('--memory', type=int, default=None, metavar='N',
+                        help='Sample RSS and tracemalloc top allocators every N events into <output>.memory.txt')
     args = parser.parse_args()
 
     main(args)
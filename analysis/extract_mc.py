@@ -1,11 +1,18 @@
 from ROOT import TFile, TTree
 
-import time
 import numpy as np
-from clustering import make_clusters_lists
-
-from output_tree import OutputTree
-from hit import Hit, TrHit
+from clustering import make_clusters_batch, sort_by_cal_distance
+
+from output_tree import OutputTree, LUMICAL_SCHEMA
+from column_cache import CacheWriter, cache_path
+from hit import HitBatch
+from columnar import ChunkReader
+from geometry import load_alignment
+from parallel import run_parallel
+from instrumentation import PhaseTimer, count_chunk, profiled, profile_path
+from memory_monitor import MemoryMonitor, memory_path
+from boundary_check import BoundaryCheck
+from channel_status import load_channel_status, DEFAULT_RUN_PERIOD
 import argparse
 
 
@@ -24,158 +31,166 @@ def extract_noise():
     return noise
 
 
-def bad_pad(sector, pad, layer):
-    """Return true if pad is bad"""
-    return ((layer == 0 and sector == 1 and pad in (62,))
-            or (layer == 0 and sector == 2 and pad in (20, 22, 57, 61, 63))
-            or (layer == 2 and sector == 1 and pad in (28, 31, 34, 63))
-            or (layer == 2 and sector == 2 and pad in (38, 53, 62))
-            or (layer == 3 and sector == 1 and pad in (63,))
-            or (layer == 3 and sector == 2 and pad in (31, 33, 52, 55, 61, 62))
-            or (layer == 4 and sector == 1 and pad in (29, 39, 41, 55, 56, 63))
-            or (layer == 4 and sector == 2 and pad in (28, 62))
-            or (layer == 5 and sector == 1 and pad in (32, 36, 40, 41, 44, 45, 49, 56, 58, 63))
-            or (layer == 5 and sector == 2 and pad in (28, 52, 54, 61, 62))
-            or (layer == 6 and sector == 1 and pad in (26, 30, 62, 63))
-            or (layer == 6 and sector == 2 and pad in (34, 42, 54, 57, 59, 60, 62))
-            or sector == -1)  # grounded channel
-
-
-
-
-def make_hits_lists(event):
-    hits_tracker1 = []
-    hits_tracker2 = []
-    hits_calorimeter = []
-
-
-
-    for (sector, pad, layer, energy,
-         hit_type, track_len,
-         p_x, p_y, p_z, p_px, p_py, p_pz, p_e) in zip(event.tr1_sector,
-                                                      event.tr1_pad,
-                                                      event.tr1_layer,
-                                                      event.tr1_energy,
-                                                      event.tr1_type,
-                                                      event.tr1_track_len,
-                                                      event.tr1_x,
-                                                      event.tr1_y,
-                                                      event.tr1_z,
-                                                      event.tr1_px,
-                                                      event.tr1_py,
-                                                      event.tr1_pz,
-                                                      event.tr1_p_energy):
-
-        # Selection as in data for tracker1
-        if (pad < 20 or sector == 0 or sector == 3
-            or energy <= 0. or bad_pad(sector, pad, layer)):
-            continue
+# MC truth of tracker hits. HitBatch field: branch name without tr1_/tr2_
+TRUTH_BRANCHES = {'type': 'type', 'track_len': 'track_len',
+                  'p_x': 'x', 'p_y': 'y', 'p_z': 'z',
+                  'p_px': 'px', 'p_py': 'py', 'p_pz': 'pz',
+                  'p_energy': 'p_energy'}
 
-        # If passed the selection create hit and add to corresponding list
-        hit = TrHit(sector, pad, layer, energy,
-               hit_type, track_len,
-               p_x, p_y, p_z, p_px, p_py, p_pz, p_e)
-
-        hits_tracker1.append(hit)
-
-    for (sector, pad, layer, energy,
-         hit_type, track_len,
-         p_x, p_y, p_z, p_px, p_py, p_pz, p_e) in zip(event.tr2_sector,
-                                                      event.tr2_pad,
-                                                      event.tr2_layer,
-                                                      event.tr2_energy,
-                                                      event.tr2_type,
-                                                      event.tr2_track_len,
-                                                      event.tr2_x,
-                                                      event.tr2_y,
-                                                      event.tr2_z,
-                                                      event.tr2_px,
-                                                      event.tr2_py,
-                                                      event.tr2_pz,
-                                                      event.tr2_p_energy):
-        # Selection as in data for tracker2
-        if (pad < 20 or sector == 0 or sector == 3
-            or energy <= 0. or bad_pad(sector, pad, layer)):
-            continue
 
-        # If passed the selection create hit and add to corresponding list
-        hits_tracker2.append(TrHit(sector, pad, layer, energy,
-                                   hit_type, track_len,
-                                   p_x, p_y, p_z, p_px, p_py, p_pz, p_e))
+HIT_BRANCHES = ['sector', 'pad', 'layer', 'energy']
+TRIGGER_BRANCHES = ['n_triggers', 'trigger1', 'trigger2', 'trigger3']
 
-    for (sector, pad, layer, energy) in zip(event.cal_sector,
-                                            event.cal_pad,
-                                            event.cal_layer,
-                                            event.cal_energy):
 
-        # Selection as in data for calorimeter
-        if (pad < 20 or layer == 7
-            or sector == 0 or sector == 3
-            or bad_pad(sector, pad, layer)):
-            continue
+def branch_groups():
+    """Return branches to read: groups of the tr1_, tr2_, cal_ arrays"""
+    groups = {prefix: [prefix + branch for branch in HIT_BRANCHES] for prefix in ('tr1_', 'tr2_', 'cal_')}
+    for prefix in ('tr1_', 'tr2_'):
+        groups[prefix] += [prefix + branch for branch in TRUTH_BRANCHES.values()]
+    return groups
 
-        # If passed the selection create hit and add to corresponding list
-        hits_calorimeter.append(Hit(sector, pad, layer, energy))
 
-    return hits_tracker1, hits_tracker2, hits_calorimeter
+def make_plane_hits(chunk, prefix, channel_status, tracker):
+    """Return HitBatch of the chunk hits in tr1_, tr2_ or cal_ branches passing selection as in data"""
+    truth = {}
+    if tracker:
+        truth = {field: chunk[prefix + branch] for field, branch in TRUTH_BRANCHES.items()}
+    hits = HitBatch(chunk[prefix + 'sector'], chunk[prefix + 'pad'], chunk[prefix + 'layer'],
+                    chunk[prefix + 'energy'], chunk.offsets[prefix], **truth)
 
+    good = ~channel_status.is_bad(hits.sector, hits.pad, hits.layer)
+    if tracker:
+        good &= ~(hits.energy <= 0.)
 
-def align_mc(hits_tr1, hits_tr2, hits_cal):
-    """Shift hit's y coordinates for misalignment"""
-    tr1_shift = -0.2480096316087952
-    tr2_shift = 0.9012092661162399
-    cal_shift = -0.6531996345075299
+    return hits.select(good)
 
-    for hit in hits_tr1:
-        hit.y -= tr1_shift
-    for hit in hits_tr2:
-        hit.y -= tr2_shift
-    for hit in hits_cal:
-        hit.y -= cal_shift
 
+def make_hits_lists(chunk, channel_status):
+    hits_tracker1 = make_plane_hits(chunk, 'tr1_', channel_status, tracker=True)
+    hits_tracker2 = make_plane_hits(chunk, 'tr2_', channel_status, tracker=True)
+    hits_calorimeter = make_plane_hits(chunk, 'cal_', channel_status, tracker=False)
 
-def main(args):
-    start_time = time.time()
+    return hits_tracker1, hits_tracker2, hits_calorimeter
+
+
+def align_mc(hits_tr1, hits_tr2, hits_cal, alignment):
+    """Move hits for misalignment. Transforms of the planes are in alignment_mc.txt"""
+    for hits in (hits_tr1, hits_tr2, hits_cal):
+        alignment.apply(hits)
+
+
+def extract(args, first, n_entries, output_path):
+    """Process entries [first, first + n_entries) of the input into the tree of output_path"""
     # Upload data for analysis
     input_file = TFile.Open(args.path_to_file, "READ")
     input_tree = input_file.lumical
-    print("Total n events in loaded files: ", input_tree.GetEntries())
+    reader = ChunkReader(input_tree, branch_groups(), TRIGGER_BRANCHES,
+                         chunk_size=args.chunk_size, n_entries=n_entries, first=first)
+
+    # Transforms of each plane to correct misalignment
+    alignment = load_alignment(args.alignment)
+
+    # Geometrical cuts and bad pads
+    channel_status = load_channel_status(args.run_period)
 
     # Create output root file.
     # Create output root file before the tree!!! It prevents memory leakage
-    output_file = OutputTree()
+    cache = CacheWriter(cache_path(output_path), LUMICAL_SCHEMA, 'lumical') if args.cache else None
+    output_file = OutputTree(output_path, cache)
 
     noise = extract_noise()
 
-    n_events = input_tree.GetEntries()
-    for idx, event in enumerate(input_tree):
-        if idx == 20000:
-            break
-
-        if idx % (1000) == 0:
-            time_min = (time.time() - start_time) // 60
-            time_sec = (time.time() - start_time) % 60
-            print('Event: {} out of {};'.format(idx, n_events), end=' ')
-            print('{} min {} sec'.format(time_min, time_sec))
+    # Optional check of MC truth positions of tracker hits
+    boundary_check = BoundaryCheck() if args.check_boundary else None
+
+    # Time of each phase of the loop
+    memory = MemoryMonitor(memory_path(output_path), args.memory) if args.memory else None
+    timer = PhaseTimer(len(reader), memory=memory)
+    with profiled(profile_path(output_path) if args.profile else None):
+        for chunk in timer.iterate('read', reader, count_chunk):
+            with timer.phase('hits') as phase:
+                hits_tr1, hits_tr2, hits_cal = make_hits_lists(chunk, channel_status)
+                n_hits = len(hits_tr1) + len(hits_tr2) + len(hits_cal)
+                phase.count(chunk.n_entries, n_hits)
+            if boundary_check is not None:
+                with timer.phase('boundary check') as phase:
+                    boundary_check.fill(hits_tr1)
+                    boundary_check.fill(hits_tr2)
+                    phase.count(chunk.n_entries, len(hits_tr1) + len(hits_tr2))
+            with timer.phase('align') as phase:
+                align_mc(hits_tr1, hits_tr2, hits_cal, alignment)
+                phase.count(chunk.n_entries, n_hits)
+            with timer.phase('cluster') as phase:
+                clusters_tr1, clusters_tr2, clusters_cal = make_clusters_batch(hits_tr1, hits_tr2, hits_cal)
+
+                # Resort clusters in trackers by distance to main cluster in calorimeter
+                clusters_tr1 = sort_by_cal_distance(clusters_tr1, clusters_cal)
+                clusters_tr2 = sort_by_cal_distance(clusters_tr2, clusters_cal)
+                phase.count(chunk.n_entries, n_hits)
+
+            with timer.phase('write') as phase:
+                triggers = {name: chunk[name] for name in TRIGGER_BRANCHES}
+                output_file.fill_chunk(triggers, hits_tr1, hits_tr2, hits_cal,
+                                       clusters_tr1, clusters_tr2, clusters_cal)
+                phase.count(chunk.n_entries)
+            timer.done(chunk.first + chunk.n_entries - reader.first)
+
+        with timer.phase('write'):
+            output_file.write_file()
+    timer.summary()
+
+    return boundary_check
 
-        hits_tr1, hits_tr2, hits_cal = make_hits_lists(event)
-        align_mc(hits_tr1, hits_tr2, hits_cal)
-        clusters_tr1, clusters_tr2, clusters_cal = make_clusters_lists(hits_tr1, hits_tr2, hits_cal)
 
-        # Resort clusters in trackers by distance to main cluster in calorimeter
-        if len(clusters_cal) != 0:
-            clusters_tr1.sort(key=lambda x: abs(x.y - clusters_cal[0].y))
-            clusters_tr2.sort(key=lambda x: abs(x.y - clusters_cal[0].y))
-
-        output_file.fill_output_tree(event, hits_tr1, hits_tr2, hits_cal, clusters_tr1, clusters_tr2, clusters_cal)
-
-    output_file.write_file()
+def main(args):
+    input_file = TFile.Open(args.path_to_file, "READ")
+    n_total = input_file.lumical.GetEntries()
+    print("Total n events in loaded files: ", n_total)
+    input_file.Close()
+    n_events = min(n_total, args.max_events)
+
+    output_path = args.output
+    if args.workers > 1:
+        # Entry ranges in separate processes, outputs are merged in the order of entries
+        boundary_checks = run_parallel(extract, args, n_events, args.workers, output_path, 'lumical',
+                                       cache=args.cache, profile=args.profile, memory=bool(args.memory))
+    else:
+        boundary_checks = [extract(args, 0, n_events, output_path)]
+
+    if args.cache:
+        print("Column cache: ", cache_path(output_path))
+    if args.check_boundary:
+        boundary_check = boundary_checks[0]
+        for part_check in boundary_checks[1:]:
+            boundary_check.add(part_check)
+        print(boundary_check.summary())
+        boundary_check.write("./boundary_check.txt")
     print("Hooray, extracted tree file is ready, take it :3")
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description=('Do selection and clustering of data/MC'))
     parser.add_argument('path_to_file', type=str, help='Provide path to the root file')
+    parser.add_argument('--output', type=str, default='./extracted_mc_RENAME.root',
+                        help='Output root file')
+    parser.add_argument('--alignment', type=str, default='./alignment_mc.txt',
+                        help='File with alignment transforms of each layer')
+    parser.add_argument('--check-boundary', action='store_true',
+                        help='Check MC truth positions of tracker hits against their pads')
+    parser.add_argument('--run-period', type=str, default=DEFAULT_RUN_PERIOD,
+                        help='Run period of the channel status file')
+    parser.add_argument('--chunk-size', type=int, default=10000,
+                        help='Number of events read at once')
+    parser.add_argument('--max-events', type=int, default=20000,
+                        help='Number of events to process from the start of the tree')
+    parser.add_argument('--cache', action='store_true',
+                        help='Also write .npy columns of the output tree into <output>_columns/')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of processes, each processes its own range of entries')
+    parser.add_argument('--profile', action='store_true',
+                        help='Profile the event loop with cProfile, stats are written into <output>.prof')
+    parser.add_argument('--memory', type=int, default=None, metavar='N',
+                        help='Sample RSS and tracemalloc top allocators every N events into <output>.memory.txt')
     args = parser.parse_args()
 
     main(args)
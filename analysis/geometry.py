@@ -0,0 +1,78 @@
+'''
+Geometry of the LumiCal sensors.
+Pad centres are computed once into (4, 64, 8) tables [sector, pad, layer].
+Misalignment of each layer is described by a transform read from a file:
+rotation around the beam axis followed by a shift
+    x' = cos(a) * x - sin(a) * y + dx
+    y' = sin(a) * x + cos(a) * y + dy
+'''
+
+import numpy as np
+
+
+N_SECTORS = 4
+N_PADS = 64
+N_LAYERS = 8
+
+
+def pad_rho(pad):
+    """Radius of the pad centre in mm"""
+    return 80. + 0.9 + 1.8 * pad
+
+
+def sector_phi(sector):
+    """Angle of the sector centre in rad"""
+    return np.pi * (0.5 + 1. / 12 - 1. / 48 - 1. / 24 * sector)
+
+
+def make_pad_centres():
+    """Return x, y (4, 64, 8) tables of pad centres"""
+    rho = pad_rho(np.arange(N_PADS, dtype=np.float64))
+    phi = sector_phi(np.arange(N_SECTORS, dtype=np.float64))
+    x = rho[np.newaxis, :] * np.cos(phi)[:, np.newaxis]
+    y = rho[np.newaxis, :] * np.sin(phi)[:, np.newaxis]
+    x = np.repeat(x[:, :, np.newaxis], N_LAYERS, axis=2)
+    y = np.repeat(y[:, :, np.newaxis], N_LAYERS, axis=2)
+    return x, y
+
+
+PAD_X, PAD_Y = make_pad_centres()
+
+
+def pad_position(sector, pad, layer):
+    """Return x, y of the pad centres. Accepts ints or arrays"""
+    return PAD_X[sector, pad, layer], PAD_Y[sector, pad, layer]
+
+
+class Alignment:
+    """dx, dy (mm) and rotation (rad) arrays of the transform of each layer"""
+    def __init__(self, dx=None, dy=None, rotation=None):
+        self.dx = np.zeros(N_LAYERS) if dx is None else np.asarray(dx, dtype=np.float64)
+        self.dy = np.zeros(N_LAYERS) if dy is None else np.asarray(dy, dtype=np.float64)
+        self.rotation = np.zeros(N_LAYERS) if rotation is None else np.asarray(rotation, dtype=np.float64)
+
+    def transform(self, x, y, layer):
+        """Return aligned x, y"""
+        cos = np.cos(self.rotation)[layer]
+        sin = np.sin(self.rotation)[layer]
+        return (cos * x - sin * y + self.dx[layer],
+                sin * x + cos * y + self.dy[layer])
+
+    def apply(self, hits):
+        """Align positions of the HitBatch in place"""
+        hits.x, hits.y = self.transform(hits.x, hits.y, hits.layer)
+
+
+def load_alignment(alignment_file):
+    """Return Alignment read from the file. Layers not in the file are not moved"""
+    alignment = Alignment()
+    with open(alignment_file, 'r') as file:
+        for line in file:
+            values = line.split()
+            if not values or values[0].startswith('#'):
+                continue
+            layer = int(values[0])
+            alignment.dx[layer] = float(values[1])
+            alignment.dy[layer] = float(values[2])
+            alignment.rotation[layer] = float(values[3])
+    return alignment
@@ -1,4 +1,6 @@
 import numpy as np
+from geometry import pad_rho, sector_phi, pad_position
+from boundary_check import inside_boundary
 
 class Hit:
     def __init__(self, s, p, l, e_in_mev):
@@ -6,8 +8,8 @@ class Hit:
         self.pad = p
         self.layer = l
         self.energy = e_in_mev
-        self.rho = 80. + 0.9 + 1.8 * p
-        self.phi = np.pi * (0.5 + 1. / 12 - 1. / 48 - 1. / 24 * s)
+        self.rho = pad_rho(p)
+        self.phi = sector_phi(s)
         self.x = self.rho * np.cos(self.phi)
         self.y = self.rho * np.sin(self.phi)
 
@@ -29,15 +31,107 @@ class TrHit(Hit):
         self.p_energy = p_energy
         self.seed = -1
         self.shared = False
-        self.check_boundary()
-
-    def check_boundary(self):
-        # Get the true position in the detector coord system
-        misalignment = 0
-        p_x = -self.p_x
-        p_y = self.p_y + 164.3 + misalignment
-        rho = np.sqrt(p_x**2 + p_y**2)
-        phi = np.arctan(p_y/p_x)
-        print("{} < {} < {} - ? {}".format(self.phi - np.pi/12, phi, self.phi + np.pi/12, self.phi - np.pi/12 < phi < self.phi + np.pi/12))
-        print("{} < {} < {} - ? {}".format(self.rho - 0.9, rho, self.rho + 0.9, self.rho - 0.9 < rho < self.rho + 0.9))
-        input("wait")
+
+    def check_boundary(self, misalignment=0):
+        """Return True if true particle position is inside the pad window. See boundary_check.py"""
+        inside_rho, inside_phi = inside_boundary(HitBatch.from_hits([self]), misalignment)
+        return bool(inside_rho[0] and inside_phi[0])
+
+
+class HitBatch:
+    '''
+    Hits of one or many events kept as contiguous arrays instead of Hit objects.
+    Hits of event i are [offsets[i]:offsets[i + 1]].
+    MC truth fields (type, track_len, p_*) are None for data.
+    '''
+    TRUTH_FIELDS = ('type', 'track_len', 'p_x', 'p_y', 'p_z', 'p_px', 'p_py', 'p_pz', 'p_energy')
+
+    def __init__(self, sector, pad, layer, energy, offsets=None, x=None, y=None, **truth):
+        self.sector = np.asarray(sector, dtype=np.int32)
+        self.pad = np.asarray(pad, dtype=np.int32)
+        self.layer = np.asarray(layer, dtype=np.int32)
+        self.energy = np.asarray(energy, dtype=np.float64)
+        # Single event if offsets are not given
+        if offsets is None:
+            offsets = [0, len(self.sector)]
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+
+        # Pad centres before alignment
+        if x is None or y is None:
+            x, y = pad_position(self.sector, self.pad, self.layer)
+        self.x = np.asarray(x, dtype=np.float64)
+        self.y = np.asarray(y, dtype=np.float64)
+
+        for field in self.TRUTH_FIELDS:
+            value = truth.pop(field, None)
+            if value is not None:
+                value = np.asarray(value, dtype=np.int32 if field == 'type' else np.float64)
+            setattr(self, field, value)
+        if truth:
+            raise TypeError("Unknown hit fields: {}".format(", ".join(truth)))
+
+    @property
+    def has_truth(self):
+        return self.type is not None
+
+    @property
+    def n_events(self):
+        return len(self.offsets) - 1
+
+    def __len__(self):
+        return len(self.sector)
+
+    def fields(self):
+        """Return dict of all not empty per-hit arrays"""
+        names = ('sector', 'pad', 'layer', 'energy', 'x', 'y') + (self.TRUTH_FIELDS if self.has_truth else ())
+        return {name: getattr(self, name) for name in names}
+
+    def event_index(self):
+        """Return event number of each hit"""
+        return np.repeat(np.arange(self.n_events), np.diff(self.offsets))
+
+    def take(self, idx, offsets=None):
+        """Return new batch with hits idx. Single event unless offsets given"""
+        arrays = {name: array[idx] for name, array in self.fields().items()}
+        return HitBatch(offsets=offsets, **arrays)
+
+    def select(self, mask):
+        """Return new batch with hits passing mask. Events are kept even if empty"""
+        counts = np.bincount(self.event_index()[mask], minlength=self.n_events)
+        offsets = np.zeros(self.n_events + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        return self.take(np.flatnonzero(mask), offsets)
+
+    def event(self, i):
+        """Return hits of event i. Arrays are views, not copies"""
+        begin, end = self.offsets[i], self.offsets[i + 1]
+        arrays = {name: array[begin:end] for name, array in self.fields().items()}
+        return HitBatch(**arrays)
+
+    def events(self):
+        for i in range(self.n_events):
+            yield self.event(i)
+
+    @classmethod
+    def concatenate(cls, batches):
+        """Return one batch with events of all batches"""
+        batches = list(batches)
+        offsets = [np.zeros(1, dtype=np.int64)]
+        n_hits = 0
+        for batch in batches:
+            offsets.append(batch.offsets[1:] - batch.offsets[0] + n_hits)
+            n_hits += batch.offsets[-1] - batch.offsets[0]
+        names = batches[0].fields().keys() if batches else ('sector', 'pad', 'layer', 'energy', 'x', 'y')
+        arrays = {name: np.concatenate([getattr(batch, name)[batch.offsets[0]:batch.offsets[-1]] for batch in batches])
+                  if batches else np.zeros(0) for name in names}
+        return cls(offsets=np.concatenate(offsets), **arrays)
+
+    @classmethod
+    def from_hits(cls, hits_list):
+        """Return single event batch out of list of Hit or TrHit objects"""
+        arrays = {name: [getattr(hit, name) for hit in hits_list]
+                  for name in ('sector', 'pad', 'layer', 'energy', 'x', 'y')}
+        if hits_list and isinstance(hits_list[0], TrHit):
+            arrays.update({name: [getattr(hit, name) for hit in hits_list]
+                           for name in cls.TRUTH_FIELDS})
+        return cls(**arrays)
@@ -0,0 +1,155 @@
+'''
+Timing of the phases of the event loop (read, hits, align, cluster, write, ...).
+Each phase accumulates its wall time and the number of events and hits it processed.
+Progress with events/s and hits/s of each phase is printed every report_interval
+seconds and the totals at the end:
+    timer = PhaseTimer(n_events)
+    for chunk in timer.iterate('read', reader, count_chunk):
+        with timer.phase('hits') as phase:
+            hits = make_hits(chunk)
+            phase.count(chunk.n_entries, len(hits))
+        timer.done(chunk.first + chunk.n_entries)
+    timer.summary()
+profiled() wraps the event loop into cProfile for --profile,
+merge_profiles() adds up the profiles of parallel workers.
+'''
+
+import time
+import cProfile
+import pstats
+import contextlib
+
+
+class Phase:
+    def __init__(self, name):
+        self.name = name
+        self.seconds = 0.
+        self.n_events = 0
+        self.n_hits = 0
+
+    def count(self, n_events, n_hits=0):
+        self.n_events += n_events
+        self.n_hits += n_hits
+
+    def rates(self):
+        """Return events/s and hits/s of the phase"""
+        if self.seconds <= 0.:
+            return 0., 0.
+        return self.n_events / self.seconds, self.n_hits / self.seconds
+
+    def __str__(self):
+        events_rate, hits_rate = self.rates()
+        line = '{}: {:.1f} sec, {:.0f} events/sec'.format(self.name, self.seconds, events_rate)
+        if self.n_hits:
+            line += ', {:.0f} hits/sec'.format(hits_rate)
+        return line
+
+
+class PhaseTimer:
+    """
+    Phases of the event loop in the order of their first use.
+    memory: optional memory_monitor.MemoryMonitor sampled with the number of finished events
+    """
+    def __init__(self, n_events, report_interval=30., memory=None):
+        self.n_events = n_events
+        self.report_interval = report_interval
+        self.start_time = time.time()
+        self.last_report = None
+        self.n_done = 0
+        self.phases = {}
+        self.memory = memory
+        if memory is not None:
+            memory.sample(0)
+
+    def get(self, name):
+        if name not in self.phases:
+            self.phases[name] = Phase(name)
+        return self.phases[name]
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        phase = self.get(name)
+        start = time.perf_counter()
+        try:
+            yield phase
+        finally:
+            phase.seconds += time.perf_counter() - start
+
+    def iterate(self, name, iterable, count=None):
+        """Yield items of iterable, time spent in getting them goes to the phase.
+        count(item) returns (n_events, n_hits) of the item, by default it is one event"""
+        phase = self.get(name)
+        iterator = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                phase.seconds += time.perf_counter() - start
+                return
+            phase.seconds += time.perf_counter() - start
+            phase.count(*(count(item) if count is not None else (1,)))
+            yield item
+
+    def done(self, n_done):
+        """Set number of finished events, prints progress if the report is due"""
+        self.n_done = n_done
+        if self.memory is not None:
+            self.memory.sample(n_done)
+        now = time.time()
+        if self.last_report is None or now - self.last_report >= self.report_interval:
+            self.last_report = now
+            self.report()
+
+    def report(self):
+        elapsed = time.time() - self.start_time
+        print('Event: {} out of {}; {} min {:.0f} sec'.format(self.n_done, self.n_events,
+                                                               elapsed // 60, elapsed % 60), end='')
+        if self.phases:
+            print('; ' + '; '.join(str(phase) for phase in self.phases.values()), end='')
+        print()
+
+    def summary(self):
+        elapsed = time.time() - self.start_time
+        print('Processed {} events in {} min {:.0f} sec, {:.0f} events/sec'.format(
+            self.n_done, elapsed // 60, elapsed % 60, self.n_done / elapsed if elapsed > 0 else 0.))
+        for phase in self.phases.values():
+            print('    ' + str(phase))
+        if self.memory is not None:
+            self.memory.close()
+
+
+def count_chunk(chunk):
+    """Return n of events and n of array elements (hits, signals) of columnar.Chunk"""
+    return chunk.n_entries, int(sum(offsets[-1] for offsets in chunk.offsets.values()))
+
+
+def profile_path(output_path):
+    """cProfile stats of --profile are written next to the output"""
+    base = output_path[:-len('.root')] if output_path.endswith('.root') else output_path
+    return base + '.prof'
+
+
+@contextlib.contextmanager
+def profiled(path, n_lines=25):
+    """Run the block under cProfile if path is not None, write stats into path and print the top"""
+    if path is None:
+        yield
+        return
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        profiler.dump_stats(path)
+        print("Profile is written into ", path)
+        pstats.Stats(profiler).sort_stats('cumulative').print_stats(n_lines)
+
+
+def merge_profiles(part_paths, path, n_lines=25):
+    """Add up cProfile stats of part_paths into path and print the top"""
+    stats = pstats.Stats(*part_paths)
+    stats.dump_stats(path)
+    print("Profile is written into ", path)
+    stats.sort_stats('cumulative').print_stats(n_lines)
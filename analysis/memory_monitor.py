@@ -0,0 +1,139 @@
+'''
+Memory monitoring of long event loops.
+Every `every` events the RSS of the process and the memory traced by tracemalloc
+are sampled and written into the timeline file next to the output, together with
+the top allocators (file:line) and their growth since the previous sample.
+If RSS has grown in each of the last n_growth samples the growth per event is printed
+as a warning: memory which is not freed between chunks (e.g. per-event
+Hit/Tower objects or ROOT objects) shows up as a steady growth.
+Where current RSS is not available (not Linux) the timeline has the peak RSS,
+which never decreases, so there is no growth warning.
+tracemalloc slows the loop down, the monitor is off by default (--memory N).
+'''
+
+import sys
+import time
+import resource
+import tracemalloc
+
+
+def current_rss():
+    """Return resident set size of the process in bytes, None if it is not available (not Linux)"""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def peak_rss():
+    """Return peak resident set size of the process in bytes"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kB on Linux, bytes on macOS
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def memory_path(output_path):
+    """Memory timeline is written next to the output"""
+    base = output_path[:-len('.root')] if output_path.endswith('.root') else output_path
+    return base + '.memory.txt'
+
+
+class MemoryMonitor:
+    def __init__(self, path, every=10000, n_top=10, n_growth=5):
+        self.path = path
+        self.every = every
+        self.n_top = n_top
+        self.n_growth = n_growth
+        self.next_sample = 0
+        self.start_time = time.time()
+        # (n_events, rss) of all samples
+        self.samples = []
+        self.warned = False
+        # Only peak RSS is sampled if the current one is not available
+        self.peak_only = current_rss() is None
+
+        tracemalloc.start()
+        self.snapshot = None
+        self.file = open(path, 'w')
+        self.file.write("# n_events  time_sec  {}  traced_mb  traced_peak_mb\n".format(
+            'peak_rss_mb' if self.peak_only else 'rss_mb'))
+
+    def sample(self, n_events):
+        """Sample memory if n_events passed the next sampling point"""
+        if n_events < self.next_sample:
+            return
+        self.next_sample = (n_events // self.every + 1) * self.every
+
+        rss = peak_rss() if self.peak_only else current_rss()
+        traced, traced_peak = tracemalloc.get_traced_memory()
+        self.samples.append((n_events, rss))
+        self.file.write("{}  {:.1f}  {:.1f}  {:.1f}  {:.1f}\n".format(
+            n_events, time.time() - self.start_time, rss / 2**20, traced / 2**20, traced_peak / 2**20))
+        self.write_top()
+        self.file.flush()
+        self.check_growth()
+
+    def write_top(self):
+        """Write top allocators and their growth since the previous sample as comments"""
+        snapshot = tracemalloc.take_snapshot().filter_traces([
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, __file__)])
+        if self.snapshot is None:
+            stats = snapshot.statistics('lineno')
+            lines = ["#   {:.1f} kB in {} blocks: {}".format(stat.size / 1024, stat.count, stat.traceback)
+                     for stat in stats[:self.n_top]]
+        else:
+            stats = snapshot.compare_to(self.snapshot, 'lineno')
+            lines = ["#   {:.1f} kB ({:+.1f} kB) in {} blocks: {}".format(
+                stat.size / 1024, stat.size_diff / 1024, stat.count, stat.traceback) for stat in stats[:self.n_top]]
+        self.snapshot = snapshot
+        self.file.write("\n".join(lines) + "\n")
+
+    def growth(self, samples):
+        """Return RSS growth in bytes per event between the first and the last sample"""
+        (first_events, first_rss), (last_events, last_rss) = samples[0], samples[-1]
+        if last_events == first_events:
+            return 0.
+        return (last_rss - first_rss) / (last_events - first_events)
+
+    def check_growth(self):
+        if self.peak_only:
+            return
+        last = self.samples[-self.n_growth - 1:]
+        if len(last) <= self.n_growth:
+            return
+        if all(rss2 > rss1 for (_, rss1), (_, rss2) in zip(last[:-1], last[1:])):
+            message = "RSS grows in the last {} samples: {:.0f} bytes/event, {:.1f} MB now".format(
+                self.n_growth, self.growth(last), last[-1][1] / 2**20)
+            if not self.warned:
+                print("Memory warning:", message)
+            self.file.write("# WARNING " + message + "\n")
+            self.warned = True
+
+    def close(self):
+        tracemalloc.stop()
+        if self.samples:
+            peak = max(peak_rss(), max(rss for _, rss in self.samples))
+            summary = "Memory: peak RSS {:.1f} MB".format(peak / 2**20)
+            if not self.peak_only:
+                summary += ", growth {:.0f} bytes/event over the run{}".format(
+                    self.growth(self.samples), ", steady growth seen" if self.warned else "")
+            print(summary)
+            self.file.write("# " + summary + "\n")
+        self.file.close()
+        print("Memory timeline is written into ", self.path)
+
+
+def merge_timelines(part_paths, path):
+    """Write timelines of parallel workers one after another into path,
+    n_events of each part are counted from the start of its range"""
+    with open(path, 'w') as output:
+        for idx, part_path in enumerate(part_paths):
+            output.write("# part {}\n".format(idx))
+            with open(part_path) as f:
+                output.write(f.read())
+    print("Memory timeline is written into ", path)
@@ -1,249 +1,172 @@
+'''
+Writing of the output trees in chunks of events.
+Layout of the tree is a schema: list of (branch, leaf type, counter) in the order of the branches.
+Counter is None for scalar branches, otherwise it is the name of the scalar branch
+with the length of the array in each event (e.g. tr1_hit_pad[tr1_n_hits]).
+ChunkWriter takes flat arrays of many events with their offsets,
+copies each event with slices into numpy buffers and grows them if an event does not fit.
+'''
+
 from ROOT import TFile, TTree
-import array
+import numpy as np
+
+
+LEAF_DTYPES = {'I': np.int32, 'F': np.float32}
+
+# (branch name without tr1_/tr2_/cal_, leaf type, HitBatch or ClusterBatch field)
+TRIGGER_FIELDS = [('n_triggers', 'I'), ('trigger1', 'I'), ('trigger2', 'I'), ('trigger3', 'I')]
+HIT_FIELDS = [('hit_pad', 'I', 'pad'), ('hit_sector', 'I', 'sector'), ('hit_layer', 'I', 'layer'),
+              ('hit_x', 'F', 'x'), ('hit_y', 'F', 'y'), ('hit_energy', 'F', 'energy')]
+TRUTH_FIELDS = [('hit_type', 'I', 'type'), ('track_len', 'F', 'track_len'),
+                ('particle_x', 'F', 'p_x'), ('particle_y', 'F', 'p_y'), ('particle_z', 'F', 'p_z'),
+                ('particle_px', 'F', 'p_px'), ('particle_py', 'F', 'p_py'), ('particle_pz', 'F', 'p_pz'),
+                ('particle_energy', 'F', 'p_energy')]
+TR_CLUSTER_FIELDS = [('cluster_n_pads', 'I', 'n_pads'), ('cluster_pad', 'F', 'pad'),
+                     ('cluster_sector', 'F', 'sector'), ('cluster_x', 'F', 'x'),
+                     ('cluster_y', 'F', 'y'), ('cluster_energy', 'F', 'energy')]
+CAL_CLUSTER_FIELDS = [('cluster_n_pads', 'I', 'n_pads'), ('cluster_n_towers', 'I', 'n_towers'),
+                      ('cluster_pad', 'F', 'pad'), ('cluster_sector', 'F', 'sector'),
+                      ('cluster_layer', 'F', 'layer'), ('cluster_x', 'F', 'x'),
+                      ('cluster_y', 'F', 'y'), ('cluster_energy', 'F', 'energy')]
+
+
+def trigger_schema():
+    return [(name, leaf_type, None) for name, leaf_type in TRIGGER_FIELDS]
+
+
+def hits_schema(prefix, truth=False):
+    fields = HIT_FIELDS + (TRUTH_FIELDS if truth else [])
+    counter = prefix + 'n_hits'
+    return [(counter, 'I', None)] + [(prefix + name, leaf_type, counter) for name, leaf_type, _ in fields]
+
+
+def clusters_schema(prefix):
+    fields = CAL_CLUSTER_FIELDS if prefix == 'cal_' else TR_CLUSTER_FIELDS
+    counter = prefix + 'n_clusters'
+    return [(counter, 'I', None)] + [(prefix + name, leaf_type, counter) for name, leaf_type, _ in fields]
+
+
+def hits_columns(prefix, hits, truth=False):
+    """Return columns and offsets of HitBatch for hits_schema"""
+    fields = HIT_FIELDS + (TRUTH_FIELDS if truth else [])
+    columns = {prefix + name: getattr(hits, field) for name, _, field in fields}
+    return columns, {prefix + 'n_hits': hits.offsets}
+
+
+def clusters_columns(prefix, clusters):
+    """Return columns and offsets of ClusterBatch for clusters_schema"""
+    fields = CAL_CLUSTER_FIELDS if prefix == 'cal_' else TR_CLUSTER_FIELDS
+    columns = {prefix + name: getattr(clusters, field) for name, _, field in fields}
+    return columns, {prefix + 'n_clusters': clusters.offsets}
+
+
+def signals_schema(keep_nn=False):
+    """Layout of the data tree of signals_selection.py: hits without plane prefix"""
+    names = [('pad', 'I'), ('sector', 'I'), ('layer', 'I'), ('energy', 'F')]
+    if keep_nn:
+        names.append(('nn_output', 'F'))
+    return [('n_hits', 'I', None)] + [(name, leaf_type, 'n_hits') for name, leaf_type in names]
+
+
+# Layouts of the trees of extract_mc.py (lumical), extract_data.py (data),
+# do_mc_geocuts.py and cluster_tracker.py
+LUMICAL_SCHEMA = (trigger_schema()
+                  + hits_schema('tr1_', truth=True) + clusters_schema('tr1_')
+                  + hits_schema('tr2_', truth=True) + clusters_schema('tr2_')
+                  + hits_schema('cal_') + clusters_schema('cal_'))
+DATA_SCHEMA = (hits_schema('tr1_') + clusters_schema('tr1_')
+               + hits_schema('tr2_') + clusters_schema('tr2_')
+               + hits_schema('cal_') + clusters_schema('cal_'))
+GEOCUTS_SCHEMA = trigger_schema() + hits_schema('tr1_') + hits_schema('tr2_') + hits_schema('cal_')
+TR_CLUSTERS_SCHEMA = clusters_schema('tr1_') + clusters_schema('tr2_')
+
+
+class ChunkWriter:
+    """Fills the tree with the branches of the schema from whole chunks of events"""
+    def __init__(self, tree, schema, initial_size=128):
+        self.tree = tree
+        self.schema = schema
+        self.counters = {counter for _, _, counter in schema if counter is not None}
+        self.buffers = {}
+        for name, leaf_type, counter in schema:
+            size = 1 if counter is None else initial_size
+            self.buffers[name] = np.zeros(size, dtype=LEAF_DTYPES[leaf_type])
+            if counter is None:
+                leaf_list = '{}/{}'.format(name, leaf_type)
+            else:
+                leaf_list = '{}[{}]/{}'.format(name, counter, leaf_type)
+            tree.Branch(name, self.buffers[name], leaf_list)
+
+    def reserve(self, counter, size):
+        """Grow buffers of the arrays with counter to hold size elements"""
+        for name, _, branch_counter in self.schema:
+            buffer = self.buffers[name]
+            if branch_counter == counter and len(buffer) < size:
+                self.buffers[name] = np.zeros(max(size, 2 * len(buffer)), dtype=buffer.dtype)
+                self.tree.SetBranchAddress(name, self.buffers[name])
+
+    def fill(self, n_events, columns, offsets):
+        """
+        Fill n_events entries.
+        columns: branch -> values of all events (scalars: one per event, arrays: flat).
+        offsets: counter -> offsets of its arrays, counters are filled from them.
+        """
+        for counter in self.counters:
+            counts = np.diff(offsets[counter])
+            if len(counts):
+                self.reserve(counter, counts.max())
+
+        # Values converted once per chunk to the leaf types
+        scalars = []
+        arrays = []
+        for name, _, counter in self.schema:
+            buffer = self.buffers[name]
+            if name in self.counters:
+                scalars.append((buffer, np.diff(offsets[name]).astype(buffer.dtype)))
+            elif counter is None:
+                scalars.append((buffer, np.asarray(columns[name]).astype(buffer.dtype)))
+            else:
+                arrays.append((buffer, np.asarray(columns[name]).astype(buffer.dtype),
+                               (offsets[counter] - offsets[counter][0]).tolist()))
+
+        for i in range(n_events):
+            for buffer, values in scalars:
+                buffer[0] = values[i]
+            for buffer, values, array_offsets in arrays:
+                begin, end = array_offsets[i], array_offsets[i + 1]
+                buffer[:end - begin] = values[begin:end]
+            self.tree.Fill()
+
 
 class OutputTree:
-    def __init__(self):
-        self.output_file = TFile("./extracted_mc_RENAME.root", "RECREATE")
+    """lumical tree of extract_mc.py"""
+    def __init__(self, path="./extracted_mc_RENAME.root", cache=None):
+        # Create output root file before the tree!!! It prevents memory leakage
+        self.output_file = TFile(path, "RECREATE")
         self.output_tree = TTree('lumical', 'MC preprocessed')
-        self.define_variables()
-        self.define_leafs()
-
-    def define_variables(self):
-        self.n_triggers = array.array('i', [0])
-        self.trigger1 = array.array('i', [0])
-        self.trigger2 = array.array('i', [0])
-        self.trigger3 = array.array('i', [0])
-
-        self.tr1_n_hits = array.array('i', [0])
-        self.tr1_hit_pad = array.array('i', [0] * 128)
-        self.tr1_hit_sector = array.array('i', [0] * 128)
-        self.tr1_hit_layer = array.array('i', [0] * 128)
-        self.tr1_hit_x = array.array('f', [0.0] * 128)
-        self.tr1_hit_y = array.array('f', [0.0] * 128)
-        self.tr1_hit_energy = array.array('f', [0.0] * 128)
-
-        self.tr1_hit_type = array.array('i', [0] * 128)
-        self.tr1_track_len = array.array('f', [0.0] * 128)
-        self.tr1_particle_x = array.array('f', [0.0] * 128)
-        self.tr1_particle_y = array.array('f', [0.0] * 128)
-        self.tr1_particle_z = array.array('f', [0.0] * 128)
-        self.tr1_particle_px = array.array('f', [0.0] * 128)
-        self.tr1_particle_py = array.array('f', [0.0] * 128)
-        self.tr1_particle_pz = array.array('f', [0.0] * 128)
-        self.tr1_particle_energy = array.array('f', [0.0] * 128)
-
-        self.tr1_n_clusters = array.array('i', [0])
-        self.tr1_cluster_n_pads = array.array('i', [0] * 128)
-        self.tr1_cluster_pad = array.array('f', [0.0] * 128)
-        self.tr1_cluster_sector = array.array('f', [0.0] * 128)
-        self.tr1_cluster_x = array.array('f', [0.0] * 128)
-        self.tr1_cluster_y = array.array('f', [0.0] * 128)
-        self.tr1_cluster_energy = array.array('f', [0.0] * 128)
-
-        self.tr2_n_hits = array.array('i', [0])
-        self.tr2_hit_pad = array.array('i', [0] * 128)
-        self.tr2_hit_sector = array.array('i', [0] * 128)
-        self.tr2_hit_layer = array.array('i', [0] * 128)
-        self.tr2_hit_x = array.array('f', [0.0] * 128)
-        self.tr2_hit_y = array.array('f', [0.0] * 128)
-        self.tr2_hit_energy = array.array('f', [0.0] * 128)
-
-        self.tr2_hit_type = array.array('i', [0] * 128)
-        self.tr2_track_len = array.array('f', [0.0] * 128)
-        self.tr2_particle_x = array.array('f', [0.0] * 128)
-        self.tr2_particle_y = array.array('f', [0.0] * 128)
-        self.tr2_particle_z = array.array('f', [0.0] * 128)
-        self.tr2_particle_px = array.array('f', [0.0] * 128)
-        self.tr2_particle_py = array.array('f', [0.0] * 128)
-        self.tr2_particle_pz = array.array('f', [0.0] * 128)
-        self.tr2_particle_energy = array.array('f', [0.0] * 128)
-
-        self.tr2_n_clusters = array.array('i', [0])
-        self.tr2_cluster_n_pads = array.array('i', [0] * 128)
-        self.tr2_cluster_pad = array.array('f', [0.0] * 128)
-        self.tr2_cluster_sector = array.array('f', [0.0] * 128)
-        self.tr2_cluster_x = array.array('f', [0.0] * 128)
-        self.tr2_cluster_y = array.array('f', [0.0] * 128)
-        self.tr2_cluster_energy = array.array('f', [0.0] * 128)
-
-        self.cal_n_hits = array.array('i', [0])
-        self.cal_hit_pad = array.array('i', [0] * 128 * 5)
-        self.cal_hit_sector = array.array('i', [0] * 128 * 5)
-        self.cal_hit_layer = array.array('i', [0] * 128 * 5)
-        self.cal_hit_x = array.array('f', [0.0] * 128 * 5)
-        self.cal_hit_y = array.array('f', [0.0] * 128 * 5)
-        self.cal_hit_energy = array.array('f', [0.0] * 128 * 5)
-
-        self.cal_n_clusters = array.array('i', [0])
-        self.cal_cluster_n_pads = array.array('i', [0] * 128 * 5)
-        self.cal_cluster_n_towers = array.array('i', [0] * 128 * 5)
-        self.cal_cluster_pad = array.array('f', [0.0] * 128 * 5)
-        self.cal_cluster_sector = array.array('f', [0.0] * 128 * 5)
-        self.cal_cluster_layer = array.array('f', [0.0] * 128 * 5)
-        self.cal_cluster_x = array.array('f', [0.0] * 128 * 5)
-        self.cal_cluster_y = array.array('f', [0.0] * 128 * 5)
-        self.cal_cluster_energy = array.array('f', [0.0] * 128 * 5)
-
-    def define_leafs(self):
-        self.output_tree.Branch('n_triggers', self.n_triggers, 'n_triggers/I')
-        self.output_tree.Branch('trigger1', self.trigger1, 'trigger1/I')
-        self.output_tree.Branch('trigger2', self.trigger2, 'trigger2/I')
-        self.output_tree.Branch('trigger3', self.trigger3, 'trigger3/I')
-
-        self.output_tree.Branch('tr1_n_hits', self.tr1_n_hits, 'tr1_n_hits/I')
-        self.output_tree.Branch('tr1_hit_pad', self.tr1_hit_pad, 'tr1_hit_pad[tr1_n_hits]/I')
-        self.output_tree.Branch('tr1_hit_sector', self.tr1_hit_sector, 'tr1_hit_sector[tr1_n_hits]/I')
-        self.output_tree.Branch('tr1_hit_layer', self.tr1_hit_layer, 'tr1_hit_layer[tr1_n_hits]/I')
-        self.output_tree.Branch('tr1_hit_x', self.tr1_hit_x, 'tr1_hit_x[tr1_n_hits]/F')
-        self.output_tree.Branch('tr1_hit_y', self.tr1_hit_y, 'tr1_hit_y[tr1_n_hits]/F')
-        self.output_tree.Branch('tr1_hit_energy', self.tr1_hit_energy, 'tr1_hit_energy[tr1_n_hits]/F')
-
-        self.output_tree.Branch('tr1_hit_type', self.tr1_hit_type, 'tr1_hit_type[tr1_n_hits]/I')
-        self.output_tree.Branch('tr1_track_len', self.tr1_track_len, 'tr1_track_len[tr1_n_hits]/F')
-        self.output_tree.Branch('tr1_particle_x', self.tr1_particle_x, 'tr1_particle_x[tr1_n_hits]/F')
-        self.output_tree.Branch('tr1_particle_y', self.tr1_particle_y, 'tr1_particle_y[tr1_n_hits]/F')
-        self.output_tree.Branch('tr1_particle_z', self.tr1_particle_z, 'tr1_particle_z[tr1_n_hits]/F')
-        self.output_tree.Branch('tr1_particle_px', self.tr1_particle_px, 'tr1_particle_px[tr1_n_hits]/F')
-        self.output_tree.Branch('tr1_particle_py', self.tr1_particle_py, 'tr1_particle_py[tr1_n_hits]/F')
-        self.output_tree.Branch('tr1_particle_pz', self.tr1_particle_pz, 'tr1_particle_pz[tr1_n_hits]/F')
-        self.output_tree.Branch('tr1_particle_energy', self.tr1_particle_energy, 'tr1_particle_energy[tr1_n_hits]/F')
-
-        self.output_tree.Branch('tr1_n_clusters', self.tr1_n_clusters, 'tr1_n_clusters/I')
-        self.output_tree.Branch('tr1_cluster_n_pads', self.tr1_cluster_n_pads, 'tr1_cluster_n_pads[tr1_n_clusters]/I')
-        self.output_tree.Branch('tr1_cluster_pad', self.tr1_cluster_pad, 'tr1_cluster_pad[tr1_n_clusters]/F')
-        self.output_tree.Branch('tr1_cluster_sector', self.tr1_cluster_sector, 'tr1_cluster_sector[tr1_n_clusters]/F')
-        self.output_tree.Branch('tr1_cluster_x', self.tr1_cluster_x, 'tr1_cluster_x[tr1_n_clusters]/F')
-        self.output_tree.Branch('tr1_cluster_y', self.tr1_cluster_y, 'tr1_cluster_y[tr1_n_clusters]/F')
-        self.output_tree.Branch('tr1_cluster_energy', self.tr1_cluster_energy, 'tr1_cluster_energy[tr1_n_clusters]/F')
-
-        self.output_tree.Branch('tr2_n_hits', self.tr2_n_hits, 'tr2_n_hits/I')
-        self.output_tree.Branch('tr2_hit_pad', self.tr2_hit_pad, 'tr2_hit_pad[tr2_n_hits]/I')
-        self.output_tree.Branch('tr2_hit_sector', self.tr2_hit_sector, 'tr2_hit_sector[tr2_n_hits]/I')
-        self.output_tree.Branch('tr2_hit_layer', self.tr2_hit_layer, 'tr2_hit_layer[tr2_n_hits]/I')
-        self.output_tree.Branch('tr2_hit_x', self.tr2_hit_x, 'tr2_hit_x[tr2_n_hits]/F')
-        self.output_tree.Branch('tr2_hit_y', self.tr2_hit_y, 'tr2_hit_y[tr2_n_hits]/F')
-        self.output_tree.Branch('tr2_hit_energy', self.tr2_hit_energy, 'tr2_hit_energy[tr2_n_hits]/F')
-
-        self.output_tree.Branch('tr2_hit_type', self.tr2_hit_type, 'tr2_hit_type[tr2_n_hits]/I')
-        self.output_tree.Branch('tr2_track_len', self.tr2_track_len, 'tr2_track_len[tr2_n_hits]/F')
-        self.output_tree.Branch('tr2_particle_x', self.tr2_particle_x, 'tr2_particle_x[tr2_n_hits]/F')
-        self.output_tree.Branch('tr2_particle_y', self.tr2_particle_y, 'tr2_particle_y[tr2_n_hits]/F')
-        self.output_tree.Branch('tr2_particle_z', self.tr2_particle_z, 'tr2_particle_z[tr2_n_hits]/F')
-        self.output_tree.Branch('tr2_particle_px', self.tr2_particle_px, 'tr2_particle_px[tr2_n_hits]/F')
-        self.output_tree.Branch('tr2_particle_py', self.tr2_particle_py, 'tr2_particle_py[tr2_n_hits]/F')
-        self.output_tree.Branch('tr2_particle_pz', self.tr2_particle_pz, 'tr2_particle_pz[tr2_n_hits]/F')
-        self.output_tree.Branch('tr2_particle_energy', self.tr2_particle_energy, 'tr2_particle_energy[tr2_n_hits]/F')
-
-        self.output_tree.Branch('tr2_n_clusters', self.tr2_n_clusters, 'tr2_n_clusters/I')
-        self.output_tree.Branch('tr2_cluster_n_pads', self.tr2_cluster_n_pads, 'tr2_cluster_n_pads[tr2_n_clusters]/I')
-        self.output_tree.Branch('tr2_cluster_pad', self.tr2_cluster_pad, 'tr2_cluster_pad[tr2_n_clusters]/F')
-        self.output_tree.Branch('tr2_cluster_sector', self.tr2_cluster_sector, 'tr2_cluster_sector[tr2_n_clusters]/F')
-        self.output_tree.Branch('tr2_cluster_x', self.tr2_cluster_x, 'tr2_cluster_x[tr2_n_clusters]/F')
-        self.output_tree.Branch('tr2_cluster_y', self.tr2_cluster_y, 'tr2_cluster_y[tr2_n_clusters]/F')
-        self.output_tree.Branch('tr2_cluster_energy', self.tr2_cluster_energy, 'tr2_cluster_energy[tr2_n_clusters]/F')
-
-        self.output_tree.Branch('cal_n_hits', self.cal_n_hits, 'cal_n_hits/I')
-        self.output_tree.Branch('cal_hit_pad', self.cal_hit_pad, 'cal_hit_pad[cal_n_hits]/I')
-        self.output_tree.Branch('cal_hit_sector', self.cal_hit_sector, 'cal_hit_sector[cal_n_hits]/I')
-        self.output_tree.Branch('cal_hit_layer', self.cal_hit_layer, 'cal_hit_layer[cal_n_hits]/I')
-        self.output_tree.Branch('cal_hit_x', self.cal_hit_x, 'cal_hit_x[cal_n_hits]/F')
-        self.output_tree.Branch('cal_hit_y', self.cal_hit_y, 'cal_hit_y[cal_n_hits]/F')
-        self.output_tree.Branch('cal_hit_energy', self.cal_hit_energy, 'cal_hit_energy[cal_n_hits]/F')
-        self.output_tree.Branch('cal_n_clusters', self.cal_n_clusters, 'cal_n_clusters/I')
-
-        self.output_tree.Branch('cal_cluster_n_pads', self.cal_cluster_n_pads, 'cal_cluster_n_pads[cal_n_clusters]/I')
-        self.output_tree.Branch('cal_cluster_n_towers', self.cal_cluster_n_towers, 'cal_cluster_n_towers[cal_n_clusters]/I')
-        self.output_tree.Branch('cal_cluster_pad', self.cal_cluster_pad, 'cal_cluster_pad[cal_n_clusters]/F')
-        self.output_tree.Branch('cal_cluster_sector', self.cal_cluster_sector, 'cal_cluster_sector[cal_n_clusters]/F')
-        self.output_tree.Branch('cal_cluster_layer', self.cal_cluster_layer, 'cal_cluster_layer[cal_n_clusters]/F')
-        self.output_tree.Branch('cal_cluster_x', self.cal_cluster_x, 'cal_cluster_x[cal_n_clusters]/F')
-        self.output_tree.Branch('cal_cluster_y', self.cal_cluster_y, 'cal_cluster_y[cal_n_clusters]/F')
-        self.output_tree.Branch('cal_cluster_energy', self.cal_cluster_energy, 'cal_cluster_energy[cal_n_clusters]/F')
-
-    def fill_output_tree(self, event, tr1_hits, tr2_hits, cal_hits, tr1_clusters, tr2_clusters, cal_clusters):
-        self.n_triggers[0] = event.n_triggers
-        self.trigger1[0] = event.trigger1
-        self.trigger2[0] = event.trigger2
-        self.trigger3[0] = event.trigger3
-
-        self.tr1_n_hits[0] = len(tr1_hits)
-        for i, hit in enumerate(tr1_hits):
-            self.tr1_hit_pad[i] = hit.pad
-            self.tr1_hit_sector[i] = hit.sector
-            self.tr1_hit_layer[i] = hit.layer
-            self.tr1_hit_energy[i] = hit.energy
-            self.tr1_hit_x[i] = hit.x
-            self.tr1_hit_y[i] = hit.y
-
-            self.tr1_hit_type[i] = hit.type
-            self.tr1_track_len[i] = hit.track_len
-            self.tr1_particle_x[i] = hit.p_x
-            self.tr1_particle_y[i] = hit.p_y
-            self.tr1_particle_z[i] = hit.p_z
-            self.tr1_particle_px[i] = hit.p_px
-            self.tr1_particle_py[i] = hit.p_py
-            self.tr1_particle_pz[i] = hit.p_pz
-            self.tr1_particle_energy[i] = hit.p_energy
-
-        self.tr1_n_clusters[0] = len(tr1_clusters)
-        for i, cluster in enumerate(tr1_clusters):
-            self.tr1_cluster_n_pads[i] = cluster.n_pads
-            self.tr1_cluster_pad[i] = cluster.pad
-            self.tr1_cluster_sector[i] = cluster.sector
-            self.tr1_cluster_x[i] = cluster.x
-            self.tr1_cluster_y[i] = cluster.y
-            self.tr1_cluster_energy[i] = cluster.energy
-
-        self.tr2_n_hits[0] = len(tr2_hits)
-        for i, hit in enumerate(tr2_hits):
-            self.tr2_hit_pad[i] = hit.pad
-            self.tr2_hit_sector[i] = hit.sector
-            self.tr2_hit_layer[i] = hit.layer
-            self.tr2_hit_energy[i] = hit.energy
-            self.tr2_hit_x[i] = hit.x
-            self.tr2_hit_y[i] = hit.y
-
-            self.tr2_hit_type[i] = hit.type
-            self.tr2_track_len[i] = hit.track_len
-            self.tr2_particle_x[i] = hit.p_x
-            self.tr2_particle_y[i] = hit.p_y
-            self.tr2_particle_z[i] = hit.p_z
-            self.tr2_particle_px[i] = hit.p_px
-            self.tr2_particle_py[i] = hit.p_py
-            self.tr2_particle_pz[i] = hit.p_pz
-            self.tr2_particle_energy[i] = hit.p_energy
-
-        self.tr2_n_clusters[0] = len(tr2_clusters)
-        for i, cluster in enumerate(tr2_clusters):
-            self.tr2_cluster_n_pads[i] = cluster.n_pads
-            self.tr2_cluster_pad[i] = cluster.pad
-            self.tr2_cluster_sector[i] = cluster.sector
-            self.tr2_cluster_x[i] = cluster.x
-            self.tr2_cluster_y[i] = cluster.y
-            self.tr2_cluster_energy[i] = cluster.energy
-
-        self.cal_n_hits[0] = len(cal_hits)
-        for i, hit in enumerate(cal_hits):
-            self.cal_hit_pad[i] = hit.pad
-            self.cal_hit_sector[i] = hit.sector
-            self.cal_hit_layer[i] = hit.layer
-            self.cal_hit_x[i] = hit.x
-            self.cal_hit_y[i] = hit.y
-            self.cal_hit_energy[i] = hit.energy
-
-        self.cal_n_clusters[0] = len(cal_clusters)
-        for i, cluster in enumerate(cal_clusters):
-            self.cal_cluster_n_pads[i] = cluster.n_pads
-            self.cal_cluster_n_towers[i] = cluster.n_towers
-            self.cal_cluster_pad[i] = cluster.pad
-            self.cal_cluster_sector[i] = cluster.sector
-            self.cal_cluster_layer[i] = cluster.layer
-            self.cal_cluster_x[i] = cluster.x
-            self.cal_cluster_y[i] = cluster.y
-            self.cal_cluster_energy[i] = cluster.energy
-
-        self.output_tree.Fill()
+        self.writer = ChunkWriter(self.output_tree, LUMICAL_SCHEMA)
+        # Optional column_cache.CacheWriter filled with the same chunks
+        self.cache = cache
+
+    def fill_chunk(self, triggers, hits_tr1, hits_tr2, hits_cal, clusters_tr1, clusters_tr2, clusters_cal):
+        """Fill all events of the chunk.
+        Triggers is dict with n_triggers, trigger1, trigger2, trigger3 arrays.
+        Hits are HitBatch, clusters are ClusterBatch of the chunk. Tracker hits must have MC truth"""
+        columns = dict(triggers)
+        offsets = {}
+        for prefix, hits, clusters in (('tr1_', hits_tr1, clusters_tr1),
+                                       ('tr2_', hits_tr2, clusters_tr2),
+                                       ('cal_', hits_cal, clusters_cal)):
+            for part_columns, part_offsets in (hits_columns(prefix, hits, truth=prefix != 'cal_'),
+                                               clusters_columns(prefix, clusters)):
+                columns.update(part_columns)
+                offsets.update(part_offsets)
+        self.writer.fill(hits_cal.n_events, columns, offsets)
+        if self.cache is not None:
+            self.cache.fill(hits_cal.n_events, columns, offsets)
 
     def write_file(self):
         self.output_tree.Write()
         self.output_file.Close()
+        if self.cache is not None:
+            self.cache.close()
@@ -0,0 +1,86 @@
+'''
+Parallel processing of the input tree over entry ranges.
+Entries are split into n_workers consecutive ranges, each range is processed
+by its own process into a part file "<output>_part<i>.root",
+then the parts are merged in the order of the ranges, so the output tree
+has the same events in the same order as a run in one process.
+Events are processed independently, so the content does not depend on the split.
+Function of the worker is function(args, first, n_entries, output_path)
+and must be defined at module level, so it can be sent to other processes.
+Its return values (e.g. summaries to be added up) are returned in the order of the ranges.
+Column caches, cProfile stats and memory timelines of the parts are merged into the ones of the output.
+'''
+
+import os
+import shutil
+import multiprocessing
+from ROOT import TChain
+from column_cache import CacheWriter, ColumnCache, cache_path
+from instrumentation import merge_profiles, profile_path
+from memory_monitor import merge_timelines, memory_path
+
+
+def split_entries(n_entries, n_parts):
+    """Return (first, n_entries) of n_parts consecutive ranges, empty ranges are dropped"""
+    bounds = [n_entries * i // n_parts for i in range(n_parts + 1)]
+    ranges = [(begin, end - begin) for begin, end in zip(bounds[:-1], bounds[1:]) if end > begin]
+    # At least one part, so the output tree exists even for empty input
+    return ranges or [(0, 0)]
+
+
+def part_path(output_path, idx):
+    base = output_path[:-len('.root')] if output_path.endswith('.root') else output_path
+    return '{}_part{}.root'.format(base, idx)
+
+
+def merge_trees(tree_name, part_paths, output_path):
+    """Merge trees of the part files in the given order into output_path"""
+    chain = TChain(tree_name)
+    for path in part_paths:
+        chain.Add(path)
+    # fast: baskets are copied without decompressing
+    chain.Merge(output_path, 'fast')
+
+
+def merge_caches(part_paths, output_path):
+    """Merge column caches of the part files in the given order"""
+    caches = [ColumnCache(cache_path(path)) for path in part_paths]
+    writer = CacheWriter(cache_path(output_path), caches[0].schema, caches[0].tree_name)
+    for cache in caches:
+        writer.append(cache)
+    writer.close()
+
+
+def run_parallel(function, args, n_entries, n_workers, output_path, tree_name, cache=False, profile=False,
+                 memory=False):
+    """
+    Process entries [0, n_entries) with function in n_workers processes and merge the outputs.
+    Return list of the function results of each range.
+    """
+    ranges = split_entries(n_entries, n_workers)
+    part_paths = [part_path(output_path, idx) for idx in range(len(ranges))]
+    print("Processing {} events in {} parts".format(n_entries, len(ranges)))
+
+    try:
+        with multiprocessing.Pool(n_workers) as pool:
+            results = pool.starmap(function, [(args, first, n, path) for (first, n), path in zip(ranges, part_paths)])
+
+        merge_trees(tree_name, part_paths, output_path)
+        if cache:
+            merge_caches(part_paths, output_path)
+        if profile:
+            merge_profiles([profile_path(path) for path in part_paths], profile_path(output_path))
+        if memory:
+            merge_timelines([memory_path(path) for path in part_paths], memory_path(output_path))
+    finally:
+        # Parts are removed also if a worker or the merge failed
+        for path in part_paths:
+            if os.path.exists(path):
+                os.remove(path)
+            if os.path.isdir(cache_path(path)):
+                shutil.rmtree(cache_path(path))
+            for extra_path in (profile_path(path), memory_path(path)):
+                if os.path.exists(extra_path):
+                    os.remove(extra_path)
+
+    return results
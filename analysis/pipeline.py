@@ -0,0 +1,277 @@
+'''
+Runner of the analysis chain.
+Stages are the scripts of this directory with their input files, output files and parameters:
+    data: signals_selection -> extract_data
+    MC:   extract_mc, cluster_tracker, do_mc_geocuts -> smear_energy, cal_efficiency
+A stage runs after the stages which make its inputs.
+Each stage is keyed by a hash of
+    - its input files: content, or the key of the stage which makes the file,
+    - source of the script and of the modules of this directory it imports,
+    - its command line parameters.
+After a successful run the key is written into "<output>.stage" of each output.
+Stage is skipped if all its outputs have the same key, so after a change
+only the changed stages and the stages after them are run again.
+    python pipeline.py --data run741.root --nn 0.5 --mc lucas.root --workdir ../trees_5gev_e
+    python pipeline.py --mc lucas.root smear_energy cal_efficiency
+'''
+
+import os
+import sys
+import ast
+import json
+import hashlib
+import subprocess
+from channel_status import DEFAULT_RUN_PERIOD
+
+import argparse
+
+
+ANALYSIS_DIR = os.path.dirname(os.path.abspath(__file__))
+CALIBRATION_DIR = os.path.normpath(os.path.join(ANALYSIS_DIR, "../apv_calibration"))
+
+
+def file_hash(path):
+    """Return sha256 of the file content. For a directory: of names and contents of all its files"""
+    h = hashlib.sha256()
+    if os.path.isdir(path):
+        for name in sorted(os.listdir(path)):
+            h.update(name.encode())
+            h.update(file_hash(os.path.join(path, name)).encode())
+        return h.hexdigest()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def local_imports(script):
+    """Return sorted paths of the script and of all modules of this directory it imports"""
+    found = set()
+    todo = [os.path.join(ANALYSIS_DIR, script)]
+    while todo:
+        path = todo.pop()
+        if path in found:
+            continue
+        found.add(path)
+        with open(path) as f:
+            tree = ast.parse(f.read(), path)
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Import):
+                names = [alias.name for alias in node.names]
+            elif isinstance(node, ast.ImportFrom) and node.module is not None:
+                names = [node.module]
+            else:
+                continue
+            for name in names:
+                module = os.path.join(ANALYSIS_DIR, name.split('.')[0] + '.py')
+                if os.path.exists(module):
+                    todo.append(module)
+    return sorted(found)
+
+
+def code_hash(script):
+    h = hashlib.sha256()
+    for path in local_imports(script):
+        h.update(os.path.basename(path).encode())
+        h.update(file_hash(path).encode())
+    return h.hexdigest()
+
+
+class Stage:
+    '''
+    Script of this directory run as "python script *args *options".
+    inputs: files (or directories) it reads, outputs: files it writes.
+    args are part of the key, options (e.g. number of workers) are not:
+    they must not change the outputs.
+    '''
+    def __init__(self, name, script, inputs, outputs, args, options=()):
+        self.name = name
+        self.script = script
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.args = list(args)
+        self.options = list(options)
+
+    def command(self):
+        return [sys.executable, self.script] + self.args + self.options
+
+
+def stamp_path(output):
+    return output + '.stage'
+
+
+def read_stamp(output):
+    if not os.path.exists(output) or not os.path.exists(stamp_path(output)):
+        return None
+    with open(stamp_path(output)) as f:
+        return json.load(f)['key']
+
+
+class Pipeline:
+    def __init__(self, stages, workdir):
+        self.stages = {stage.name: stage for stage in stages}
+        self.producer = {output: stage.name for stage in stages for output in stage.outputs}
+        # Hashes of the input files are remembered by path, size and modification time
+        self.hashes_path = os.path.join(workdir, '.pipeline_hashes.json')
+        self.hashes = {}
+        if os.path.exists(self.hashes_path):
+            with open(self.hashes_path) as f:
+                self.hashes = json.load(f)
+
+    def input_hash(self, path):
+        stat = os.stat(path)
+        stamp = [stat.st_size, stat.st_mtime_ns]
+        if os.path.isdir(path) or self.hashes.get(path, {}).get('stamp') != stamp:
+            self.hashes[path] = {'stamp': stamp, 'hash': file_hash(path)}
+        return self.hashes[path]['hash']
+
+    def order(self, targets):
+        """Return names of the stages needed for targets, each after the stages making its inputs"""
+        order = []
+        visiting = set()
+
+        def visit(name):
+            if name in order:
+                return
+            if name in visiting:
+                raise RuntimeError("Stage {} depends on itself".format(name))
+            visiting.add(name)
+            for path in self.stages[name].inputs:
+                if path in self.producer:
+                    visit(self.producer[path])
+            visiting.remove(name)
+            order.append(name)
+
+        for name in targets:
+            if name not in self.stages:
+                raise ValueError("Unknown stage {}. Stages: {}".format(name, ', '.join(self.stages)))
+            visit(name)
+        return order
+
+    def key(self, stage, keys):
+        h = hashlib.sha256()
+        h.update(code_hash(stage.script).encode())
+        for path in stage.inputs:
+            if path in self.producer:
+                h.update(keys[self.producer[path]].encode())
+            elif os.path.exists(path):
+                h.update(self.input_hash(path).encode())
+            else:
+                raise FileNotFoundError("Input {} of stage {} does not exist".format(path, stage.name))
+        h.update(json.dumps(stage.args).encode())
+        return h.hexdigest()
+
+    def run(self, targets, force=False, dry_run=False):
+        keys = {}
+        for name in self.order(targets):
+            stage = self.stages[name]
+            keys[name] = self.key(stage, keys)
+            if not force and all(read_stamp(output) == keys[name] for output in stage.outputs):
+                print("{}: up to date".format(name))
+                continue
+
+            print("{}: {}".format(name, ' '.join(stage.command())))
+            if dry_run:
+                continue
+            for output in stage.outputs:
+                if os.path.exists(stamp_path(output)):
+                    os.remove(stamp_path(output))
+            # Scripts read noise.txt, alignment and calibration files relative to this directory
+            subprocess.run(stage.command(), cwd=ANALYSIS_DIR, check=True)
+            for output in stage.outputs:
+                with open(stamp_path(output), 'w') as f:
+                    json.dump({'stage': name, 'key': keys[name], 'command': stage.command()}, f, indent=1)
+
+        with open(self.hashes_path, 'w') as f:
+            json.dump(self.hashes, f, indent=1)
+
+
+def make_stages(args):
+    def work(name):
+        return os.path.join(args.workdir, name)
+
+    def local(name):
+        return os.path.join(ANALYSIS_DIR, name)
+
+    options = ['--chunk-size', str(args.chunk_size)]
+    profile = ['--profile'] if args.profile else []
+    stages = []
+    if args.data is not None:
+        data = os.path.abspath(args.data)
+        transformed = work('data_TRANSFORMED.root')
+        stages.append(Stage('signals_selection', 'signals_selection.py',
+                            inputs=[data, CALIBRATION_DIR], outputs=[transformed],
+                            args=[data, str(args.nn), '--columnar', '--keep-nn',
+                                  '--run-period', args.run_period, '--output', transformed],
+                            options=options + profile))
+        stages.append(Stage('extract_data', 'extract_data.py',
+                            inputs=[transformed, local('alignment_data.txt'), CALIBRATION_DIR],
+                            outputs=[work('data_extracted.root')],
+                            args=[transformed, '--alignment', local('alignment_data.txt'),
+                                  '--run-period', args.run_period, '--output', work('data_extracted.root')],
+                            options=options + profile + ['--workers', str(args.workers)]))
+    if args.mc is not None:
+        mc = os.path.abspath(args.mc)
+        geocuts = work('mc_geocuts.root')
+        stages.append(Stage('extract_mc', 'extract_mc.py',
+                            inputs=[mc, local('alignment_mc.txt'), local('noise.txt'), CALIBRATION_DIR],
+                            outputs=[work('mc_extracted.root')],
+                            args=[mc, '--alignment', local('alignment_mc.txt'), '--run-period', args.run_period,
+                                  '--max-events', str(args.max_events), '--output', work('mc_extracted.root')],
+                            options=options + profile + ['--workers', str(args.workers)]))
+        stages.append(Stage('cluster_tracker', 'cluster_tracker.py',
+                            inputs=[mc], outputs=[work('mc_tr_clusters.root')],
+                            args=[mc, '--output', work('mc_tr_clusters.root')],
+                            options=options + profile))
+        stages.append(Stage('do_mc_geocuts', 'do_mc_geocuts.py',
+                            inputs=[mc, CALIBRATION_DIR], outputs=[geocuts],
+                            args=[mc, '--run-period', args.run_period, '--output', geocuts],
+                            options=options + profile))
+        stages.append(Stage('smear_energy', 'smear_energy.py',
+                            inputs=[geocuts, local('noise.txt')],
+                            outputs=[work('mc_geocuts_noise_cal.root')],
+                            args=['--input', geocuts, '--output', work('mc_geocuts_noise_cal.root')],
+                            options=profile))
+        stages.append(Stage('cal_efficiency', 'cal_efficiency.py',
+                            inputs=[geocuts, local('noise.txt')],
+                            outputs=[work('mc_geocuts_noise_cal_eff.root')],
+                            args=['--input', geocuts, '--output', work('mc_geocuts_noise_cal_eff.root')],
+                            options=profile))
+    return stages
+
+
+def main(args):
+    args.workdir = os.path.abspath(args.workdir)
+    os.makedirs(args.workdir, exist_ok=True)
+
+    pipeline = Pipeline(make_stages(args), args.workdir)
+    if args.list:
+        for name, stage in pipeline.stages.items():
+            print("{}: {} -> {}".format(name, ', '.join(stage.inputs), ', '.join(stage.outputs)))
+        return
+
+    pipeline.run(args.stages or list(pipeline.stages), force=args.force, dry_run=args.dry_run)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=('Run stages of the analysis chain which are not up to date'))
+    parser.add_argument('stages', type=str, nargs='*',
+                        help='Stages to make (with the stages before them). Default is all')
+    parser.add_argument('--data', type=str, default=None, help='apv_reco root file of data')
+    parser.add_argument('--nn', type=float, default=0.5, help='NN Cutoff of signals_selection.py')
+    parser.add_argument('--mc', type=str, default=None, help='lumical root file of MC')
+    parser.add_argument('--max-events', type=int, default=20000,
+                        help='Number of MC events processed by extract_mc.py')
+    parser.add_argument('--run-period', type=str, default=DEFAULT_RUN_PERIOD,
+                        help='Run period of the channel status file')
+    parser.add_argument('--workdir', type=str, default='./pipeline_output', help='Directory of the outputs')
+    parser.add_argument('--workers', type=int, default=1, help='Number of processes of extract_data/extract_mc')
+    parser.add_argument('--chunk-size', type=int, default=10000, help='Number of events read at once')
+    parser.add_argument('--profile', action='store_true',
+                        help='Run the stages with --profile, cProfile stats are written next to the outputs')
+    parser.add_argument('--force', action='store_true', help='Run the stages even if they are up to date')
+    parser.add_argument('--dry-run', action='store_true', help='Only print the stages which would run')
+    parser.add_argument('--list', action='store_true', help='Print the stages with their inputs and outputs')
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,122 @@
+'''
+Data chain "signals_selection.py" + "extract_data.py" in one pass.
+Each chunk of apv_reco events goes through signal selection, hits building,
+alignment and clustering in memory, without writing and reading back
+the intermediate *_TRANSFORMED.root file.
+Hits are rounded to the leaf types of the intermediate tree, so the output
+is the same as of extract_data.py on the file written by signals_selection.py.
+The intermediate tree can still be written with --write-hits.
+'''
+
+from ROOT import TFile, TTree
+import numpy as np
+from columnar import Chunk, ChunkReader
+from output_tree import ChunkWriter, DATA_SCHEMA, LEAF_DTYPES, signals_schema
+from column_cache import CacheWriter, cache_path
+from geometry import load_alignment
+from channel_status import load_channel_status, DEFAULT_RUN_PERIOD
+from signals_selection import SIGNAL_BRANCHES, select_chunk, path as calibration_path
+from extract_data import process_chunk
+from instrumentation import PhaseTimer, count_chunk, profiled, profile_path
+from memory_monitor import MemoryMonitor, memory_path
+
+import argparse
+
+
+def as_stored(hits, schema):
+    """Return Chunk of hits with values as they are read back from the tree of the schema"""
+    arrays = {name: hits[name].astype(LEAF_DTYPES[leaf_type]).astype(np.float64)
+              for name, leaf_type, counter in schema if counter is not None}
+    return Chunk(hits.first, hits.n_entries, hits.offsets, arrays)
+
+
+def main(args):
+    channel_status = load_channel_status(args.run_period, calibration_path)
+
+    # Transforms of each plane to correct misalignment
+    alignment = load_alignment(args.alignment)
+
+    input_file = TFile.Open(args.path_to_file, "READ")
+    input_tree = input_file.apv_reco
+    reader = ChunkReader(input_tree, {'signals': SIGNAL_BRANCHES}, chunk_size=args.chunk_size)
+
+    # Optional intermediate tree as of signals_selection.py
+    hits_schema = signals_schema(args.keep_nn)
+    if args.write_hits:
+        hits_path = './' + args.path_to_file + '_TRANSFORMED.root'
+        hits_file = TFile(hits_path, "RECREATE")
+        hits_tree = TTree('data', 'Extracted Data')
+        hits_writer = ChunkWriter(hits_tree, hits_schema)
+
+    # Create output root file before the tree!!! It prevents memory leakage
+    output_file = TFile(args.output, "RECREATE")
+    output_tree = TTree('data', 'Extracted Data')
+    writer = ChunkWriter(output_tree, DATA_SCHEMA)
+    cache = CacheWriter(cache_path(args.output), DATA_SCHEMA, 'data') if args.cache else None
+
+    # Time of each phase of the loop
+    memory = MemoryMonitor(memory_path(args.output), args.memory) if args.memory else None
+    timer = PhaseTimer(len(reader), memory=memory)
+    with profiled(profile_path(args.output) if args.profile else None):
+        for chunk in timer.iterate('read', reader, count_chunk):
+            with timer.phase('select') as phase:
+                hits = select_chunk(chunk, args.nn, channel_status)
+                phase.count(chunk.n_entries, int(chunk.offsets['signals'][-1]))
+            if args.write_hits:
+                with timer.phase('write hits') as phase:
+                    hits_writer.fill(hits.n_entries, hits.arrays, {'n_hits': hits.offsets['hits']})
+                    phase.count(hits.n_entries, int(hits.offsets['hits'][-1]))
+
+            columns, offsets = process_chunk(as_stored(hits, hits_schema), None, channel_status, alignment, timer)
+
+            with timer.phase('write') as phase:
+                writer.fill(hits.n_entries, columns, offsets)
+                if cache is not None:
+                    cache.fill(hits.n_entries, columns, offsets)
+                phase.count(hits.n_entries)
+            timer.done(chunk.first + chunk.n_entries)
+
+        with timer.phase('write'):
+            output_file.cd()
+            output_tree.Write()
+            output_file.Close()
+            if args.write_hits:
+                hits_file.cd()
+                hits_tree.Write()
+                hits_file.Close()
+            if cache is not None:
+                cache.close()
+    timer.summary()
+    if args.write_hits:
+        print("Selected hits: ", hits_path)
+    if cache is not None:
+        print("Column cache: ", cache.directory)
+
+    print("Hooray, extracted tree file is ready, take it :3")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=('Signals selection, clustering of data in one pass'))
+    parser.add_argument('path_to_file', type=str, help='Provide path to the apv_reco root file')
+    parser.add_argument('nn', type=float, help='NN Cutoff')
+    parser.add_argument('--output', type=str, default='./extracted_data_RENAME.root',
+                        help='Output root file with hits and clusters')
+    parser.add_argument('--alignment', type=str, default='./alignment_data.txt',
+                        help='File with alignment transforms of each layer')
+    parser.add_argument('--write-hits', action='store_true',
+                        help='Also write the tree of selected hits as signals_selection.py')
+    parser.add_argument('--keep-nn', action='store_true',
+                        help='Write NN score of each hit into the tree of selected hits')
+    parser.add_argument('--chunk-size', type=int, default=10000,
+                        help='Number of events per chunk')
+    parser.add_argument('--run-period', type=str, default=DEFAULT_RUN_PERIOD,
+                        help='Run period of the channel status file')
+    parser.add_argument('--cache', action='store_true',
+                        help='Also write .npy columns of the output tree into <output>_columns/')
+    parser.add_argument('--profile', action='store_true',
+                        help='Profile the event loop with cProfile, stats are written into <output>.prof')
+    parser.add_argument('--memory', type=int, default=None, metavar='N',
+                        help='Sample RSS and tracemalloc top allocators every N events into <output>.memory.txt')
+    args = parser.parse_args()
+
+    main(args)
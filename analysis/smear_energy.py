@@ -1,6 +1,17 @@
 import numpy as np
 from ROOT import TTree, TFile
 import array
+from instrumentation import PhaseTimer, profiled, profile_path
+import argparse
+
+parser = argparse.ArgumentParser(description=('Smearing of calorimeter hit energies of MC with noise'))
+parser.add_argument('--input', type=str, default="../trees_5gev_e/lucas_geocuts.root",
+                    help='Tree made with do_mc_geocuts.py')
+parser.add_argument('--output', type=str, default="../trees_5gev_e/lucas_geocuts_noise_cal.root",
+                    help='Output friend tree')
+parser.add_argument('--profile', action='store_true',
+                    help='Profile the event loop with cProfile, stats are written into <output>.prof')
+args = parser.parse_args()
 
 f=open("./noise.txt", "r")
 lines = f.readlines()
@@ -14,10 +25,10 @@ for line in lines[1:]:
     layer = int(values[2])
     noise[sector, pad, layer] = float(values[3])
 
-f_input = TFile.Open("../trees_5gev_e/lucas_geocuts.root", 'read')
+f_input = TFile.Open(args.input, 'read')
 t_input = f_input.lumical
 
-f_output = TFile.Open("../trees_5gev_e/lucas_geocuts_noise_cal.root", "RECREATE")
+f_output = TFile.Open(args.output, "RECREATE")
 t_output = TTree('lumical', 'MC smeared')
 
 # tr1_n_hits = array.array('i', [0])
@@ -41,42 +52,48 @@ for _ in range(6, 7):
     t_output.Branch('cal_energy_smeared{}'.format(_+1), cal_energy_smeared[_], 'cal_energy_smeared{}[cal_n_hits]/F'.format(_+1))
 
 
-for idx, event in enumerate(t_input):
-    if (idx % 1000) == 0:
-        print("Event: ", idx)
-    # if idx == 10000:
-    #     break
-    # tr1_n_hits[0] = event.tr1_n_hits
-    # for i in range(tr1_n_hits[0]):
-    #     sector = event.tr1_hit_sector[i]
-    #     pad = event.tr1_hit_pad[i]
-    #     layer = event.tr1_hit_layer[i]
-    #     energy = event.tr1_hit_energy[i]
-    #     for j in range(10):
-    #         rand_noise = np.random.normal(0., 0.1*(j+1)*noise[sector][pad][layer])
-    #         tr1_energy_smeared[j][i] = energy + rand_noise
-    #
-    # tr2_n_hits[0] = event.tr2_n_hits
-    # for i in range(tr2_n_hits[0]):
-    #     sector = event.tr2_hit_sector[i]
-    #     pad = event.tr2_hit_pad[i]
-    #     layer = event.tr2_hit_layer[i]
-    #     energy = event.tr2_hit_energy[i]
-    #     for j in range(10):
-    #         rand_noise = np.random.normal(0., 0.1*(j+1)*noise[sector][pad][layer])
-    #         tr2_energy_smeared[j][i] = energy + rand_noise
+timer = PhaseTimer(t_input.GetEntries())
+with profiled(profile_path(args.output) if args.profile else None):
+    for idx, event in enumerate(timer.iterate('read', t_input)):
+        # if idx == 10000:
+        #     break
+        with timer.phase('smear') as phase:
+            # tr1_n_hits[0] = event.tr1_n_hits
+            # for i in range(tr1_n_hits[0]):
+            #     sector = event.tr1_hit_sector[i]
+            #     pad = event.tr1_hit_pad[i]
+            #     layer = event.tr1_hit_layer[i]
+            #     energy = event.tr1_hit_energy[i]
+            #     for j in range(10):
+            #         rand_noise = np.random.normal(0., 0.1*(j+1)*noise[sector][pad][layer])
+            #         tr1_energy_smeared[j][i] = energy + rand_noise
+            #
+            # tr2_n_hits[0] = event.tr2_n_hits
+            # for i in range(tr2_n_hits[0]):
+            #     sector = event.tr2_hit_sector[i]
+            #     pad = event.tr2_hit_pad[i]
+            #     layer = event.tr2_hit_layer[i]
+            #     energy = event.tr2_hit_energy[i]
+            #     for j in range(10):
+            #         rand_noise = np.random.normal(0., 0.1*(j+1)*noise[sector][pad][layer])
+            #         tr2_energy_smeared[j][i] = energy + rand_noise
 
-    cal_n_hits[0] = event.cal_n_hits
-    for i in range(cal_n_hits[0]):
-        sector = event.cal_hit_sector[i]
-        pad = event.cal_hit_pad[i]
-        layer = event.cal_hit_layer[i]
-        energy = event.cal_hit_energy[i]
-        for j in range(6,7):
-            rand_noise = np.random.normal(0., 0.1*(j+1)*noise[sector][pad][layer])
-            cal_energy_smeared[j][i] = energy + rand_noise
+            cal_n_hits[0] = event.cal_n_hits
+            for i in range(cal_n_hits[0]):
+                sector = event.cal_hit_sector[i]
+                pad = event.cal_hit_pad[i]
+                layer = event.cal_hit_layer[i]
+                energy = event.cal_hit_energy[i]
+                for j in range(6,7):
+                    rand_noise = np.random.normal(0., 0.1*(j+1)*noise[sector][pad][layer])
+                    cal_energy_smeared[j][i] = energy + rand_noise
+            phase.count(1, cal_n_hits[0])
 
-    t_output.Fill()
+        with timer.phase('write') as phase:
+            t_output.Fill()
+            phase.count(1)
+        timer.done(idx + 1)
 
 f_output.Write()
 f_output.Close()
+timer.summary()